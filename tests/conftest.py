@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# zutun.db migrates the database it is pointed at on import, so this has to
+# happen before any test imports it.
+os.environ["ZUTUN_DB"] = os.path.join(tempfile.mkdtemp(), "zutun.db")
+os.environ.setdefault("ZUTUN_CREDS", "test:test")
@@ -0,0 +1,56 @@
+import asyncio
+
+from zutun.db import db
+from zutun.archive import archive_graveyard
+
+
+def insert_task_with_comment(cur, location):
+    # Task ids are allocated above the archived ones, like new_task does.
+    cur.execute(
+        """
+        INSERT INTO tasks (id, summary, location, state)
+        VALUES (
+            (
+                SELECT COALESCE(MAX(id), 0) + 1 FROM (
+                    SELECT MAX(id) AS id FROM tasks
+                    UNION ALL
+                    SELECT MAX(id) FROM archived_tasks
+                )
+            ),
+            'task', ?, 'Done'
+        )
+        """,
+        (location,),
+    )
+    task_id = cur.lastrowid
+    cur.execute(
+        "INSERT INTO comments (task_id, text, commenter_id) VALUES (?, ?, 1)",
+        (task_id, "comment"),
+    )
+    return task_id, cur.lastrowid
+
+
+def test_archive_after_comment_id_was_reused():
+    first_task, first_comment = asyncio.run(
+        db.transaction(lambda cur: insert_task_with_comment(cur, "graveyard"))
+    )
+    asyncio.run(archive_graveyard())
+    second_task, second_comment = asyncio.run(
+        db.transaction(lambda cur: insert_task_with_comment(cur, "backlog"))
+    )
+    assert second_comment == first_comment
+    asyncio.run(
+        db.execute(
+            "UPDATE tasks SET location = 'graveyard' WHERE id = ?", (second_task,)
+        )
+    )
+    asyncio.run(archive_graveyard())
+
+    archived = asyncio.run(
+        db.fetchall("SELECT task_id, original_id FROM archived_comments")
+    )
+    assert sorted(tuple(row) for row in archived) == [
+        (first_task, first_comment),
+        (second_task, second_comment),
+    ]
+    assert not asyncio.run(db.fetchall("SELECT id FROM comments"))
@@ -0,0 +1,19 @@
+import asyncio
+
+from zutun.app import _backlog_page
+from zutun.components import cards
+from zutun.db import db
+
+
+def insert_backlog_task(cur):
+    cur.execute("INSERT INTO tasks (summary, location) VALUES ('task', 'backlog')")
+    return cur.lastrowid
+
+
+def test_cards_are_only_rendered_with_the_page():
+    id = asyncio.run(db.transaction(insert_backlog_task))
+    items = asyncio.run(_backlog_page(id - 1, id))
+    assert cards.get(id) is None
+    page = "".join(str(item) for item in items)
+    assert f'id="task-card-{id}"' in page
+    assert cards.get(id) is not None
@@ -0,0 +1,29 @@
+import asyncio
+
+from zutun.app import _board_fragments
+from zutun.components import OobSwap
+from zutun.db import db
+
+
+def insert_chain(cur, depth):
+    """Insert a selected top-level task with a chain of open subtasks."""
+    parent_id, ids = None, []
+    for _ in range(depth):
+        cur.execute(
+            """
+            INSERT INTO tasks (summary, location, state, parent_task_id)
+            VALUES ('task', 'selected', 'ToDo', ?)
+            """,
+            (parent_id,),
+        )
+        parent_id = cur.lastrowid
+        ids.append(parent_id)
+    return ids
+
+
+def test_card_fragments_list_the_rows_they_are_nested_in():
+    ids = asyncio.run(db.transaction(lambda cur: insert_chain(cur, 4)))
+    fragments = asyncio.run(_board_fragments(ids[-1]))
+    (swap,) = [fragment for fragment in fragments if isinstance(fragment, OobSwap)]
+    assert swap.kwargs["swap"] == f"beforeend:#kanban-items-{ids[2]}-ToDo"
+    assert swap.kwargs["rows"] == " ".join(map(str, ids[:3]))
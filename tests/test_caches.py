@@ -0,0 +1,28 @@
+import asyncio
+import sqlite3
+
+from zutun.components import cards
+from zutun.db import DB_PATH, db, forget_foreign_writes
+
+INSERT_TASK = "INSERT INTO tasks (summary, location) VALUES ('task', 'backlog')"
+
+
+def cache_something():
+    asyncio.run(forget_foreign_writes())
+    cards["sentinel"] = "cached"
+
+
+def test_own_writes_keep_the_caches():
+    cache_something()
+    asyncio.run(db.execute(INSERT_TASK))
+    asyncio.run(forget_foreign_writes())
+    assert cards.get("sentinel") == "cached"
+
+
+def test_other_processes_writes_drop_the_caches():
+    cache_something()
+    with sqlite3.connect(DB_PATH) as connection:
+        connection.execute(INSERT_TASK)
+    asyncio.run(db.execute(INSERT_TASK))
+    asyncio.run(forget_foreign_writes())
+    assert cards.get("sentinel") is None
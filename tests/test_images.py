@@ -0,0 +1,26 @@
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from zutun.images import AVATAR_SIZES, AVATAR_FORMATS, render_avatar
+
+
+def encode(img, format):
+    io = BytesIO()
+    img.save(io, format=format)
+    return io.getvalue()
+
+
+def test_renders_phone_photos():
+    # What a 48 megapixel phone camera produces.
+    renditions = render_avatar(encode(Image.new("RGB", (8064, 6048)), "JPEG"))
+    assert set(renditions) == {
+        (size, mime_type) for size in AVATAR_SIZES for mime_type in AVATAR_FORMATS
+    }
+
+
+def test_refuses_images_pillow_only_warns_about():
+    # Between Image.MAX_IMAGE_PIXELS and twice that, Pillow only warns.
+    with pytest.raises(Image.DecompressionBombError):
+        render_avatar(encode(Image.new("1", (10100, 10100)), "PNG"))
@@ -0,0 +1,50 @@
+import pytest
+
+from zutun.app import TASK_QUERY, BACKLOG_PAGE_QUERY, COMMENT_QUERY
+from zutun.db import conn
+
+
+QUERIES = {
+    "board": (
+        TASK_QUERY.format(
+            conditions="tasks.location = 'selected' AND tasks.parent_task_id IS NULL"
+        ),
+        (),
+    ),
+    "backlog": (
+        TASK_QUERY.format(
+            conditions="tasks.location = 'backlog' AND tasks.parent_task_id IS NULL"
+        ),
+        (),
+    ),
+    "task": (TASK_QUERY.format(conditions="tasks.id = ?"), (1,)),
+    "subtasks": (TASK_QUERY.format(conditions="tasks.parent_task_id = ?"), (1,)),
+    "subtree": (
+        TASK_QUERY.format(
+            conditions="""
+                tasks.id IN (
+                    SELECT task_closure.descendant_id FROM task_closure
+                    JOIN tasks root ON root.id = task_closure.ancestor_id
+                    WHERE root.parent_task_id = ?
+                )
+            """
+        ),
+        (1,),
+    ),
+    "backlog page": (BACKLOG_PAGE_QUERY, (0, 100, 51)),
+    "comments": (COMMENT_QUERY.format(conditions="task_id = ?"), (1,)),
+}
+# Including the aliases the queries give them.
+LARGE_TABLES = {"tasks", "subtask", "root", "comments", "c"}
+
+
+@pytest.mark.parametrize("name", QUERIES)
+def test_no_full_table_scans(name):
+    sql, params = QUERIES[name]
+    plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params)]
+    scans = [
+        detail
+        for detail in plan
+        if detail.startswith("SCAN ") and detail.split()[1] in LARGE_TABLES
+    ]
+    assert not scans, "\n".join(plan)
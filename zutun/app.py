@@ -1,27 +1,91 @@
-import re
 import os
+import json
+import time
+import asyncio
 import base64
-from io import BytesIO
+import hashlib
+from glob import glob
+from pathlib import Path
+from functools import wraps
 from datetime import datetime
+from collections import defaultdict
+from urllib.parse import urlparse, urlencode
 
-from PIL import Image
+from PIL import Image, UnidentifiedImageError
 from humanize import naturaltime
 from sanic import Sanic
-from sanic.response import html, file, redirect, HTTPResponse
+from sanic.log import logger
+from sanic.response import html, raw, text, redirect, HTTPResponse
 
 from zutun.components import *
-from zutun.db import conn
-
+from zutun.db import db, forget_foreign_writes, store_avatar, AVATAR_EXTENSIONS
+from zutun.images import process_avatar, MAX_UPLOAD_BYTES
+from zutun.changes import record_change, feed
+from zutun.search import search
+from zutun.archive import archive_graveyard, unarchive, graveyard_page
+from zutun.assets import assets, fingerprint_urls
+from zutun.compression import (
+    MIN_SIZE,
+    COMPRESSORS,
+    negotiate,
+    compress,
+    CompressedStream,
+)
+from zutun.instrumentation import (
+    INSTRUMENT,
+    Timings,
+    current,
+    span,
+    timed_iter,
+    slow_queries,
+)
+from zutun.profiling import (
+    SORT_KEYS,
+    HOT_MODULES,
+    profiler,
+    load_profile,
+    load_sampled,
+    format_stats,
+    dump_stats,
+)
+from zutun.references import (
+    replace_references,
+    invalidate_task,
+    store_rendered,
+    rerender_dependents,
+    rerender_missing,
+)
 
 app = Sanic("zutun")
+for page_type in [LoggedOutPage, Page]:
+    page_type.__doc__ = fingerprint_urls(page_type.__doc__)
 
 
 CORRECT_AUTH = os.environ["ZUTUN_CREDS"]
-TASK_QUERY = """
+STREAM_CHUNK_SIZE = 16 * 1024
+EVENTS_KEEPALIVE = 15  # seconds
+BACKLOG_PAGE_SIZE = 50
+# Part of every ETag, so that deploying new code (or assets, whose URLs are in
+# every page) invalidates cached pages.
+BUILD = hashlib.sha256(
+    b"".join(
+        [
+            *(
+                Path(path).read_bytes()
+                for path in sorted(
+                    glob(os.path.join(os.path.dirname(__file__), "*.py"))
+                )
+            ),
+            *(asset.hash.encode() for asset in assets.values()),
+        ]
+    )
+).hexdigest()[:12]
+TASK_SELECT = """
     SELECT
         tasks.id AS id,
         tasks.summary AS summary,
         tasks.description AS description,
+        tasks.rendered_html AS rendered_html,
         tasks.location AS location,
         tasks.state AS state,
         tasks.parent_task_id AS parent_task_id,
@@ -29,20 +93,85 @@ TASK_QUERY = """
         u.name AS assignee_name,
         u.avatar AS assignee_avatar,
         tasks.assignee_id AS assignee,
+        tasks.version AS version,
+        u.version AS assignee_version,
         COALESCE(tasks.storypoints, 0) AS storypoints,
-        COUNT(subtask.id) AS n_subtasks,
-        COUNT(c.id) AS n_comments,
-        SUM(subtask.state <> 'Done') AS n_incomplete_subtasks,
-        COALESCE(SUM(subtask.storypoints), 0) AS storypoints_sum
+        (
+            SELECT COUNT(*) FROM tasks subtask
+            WHERE subtask.parent_task_id = tasks.id
+        ) AS n_subtasks,
+        (
+            SELECT COUNT(*) FROM comments c
+            WHERE c.task_id = tasks.id
+        ) AS n_comments,
+        (
+            SELECT SUM(subtask.state <> 'Done') FROM tasks subtask
+            WHERE subtask.parent_task_id = tasks.id
+        ) AS n_incomplete_subtasks,
+        (
+            SELECT COALESCE(SUM(subtask.storypoints), 0) FROM task_closure
+            JOIN tasks subtask ON subtask.id = task_closure.descendant_id
+            WHERE task_closure.ancestor_id = tasks.id AND task_closure.depth > 0
+        ) AS storypoints_sum,
+        (
+            SELECT COUNT(*) FROM task_closure
+            JOIN tasks subtask ON subtask.id = task_closure.descendant_id
+            WHERE task_closure.ancestor_id = tasks.id
+            AND task_closure.depth > 0
+            AND subtask.state <> 'Done'
+        ) AS n_open_descendants
     FROM tasks
-    LEFT OUTER JOIN tasks subtask ON subtask.parent_task_id = tasks.id
     LEFT JOIN users u ON tasks.assignee_id = u.id
-    LEFT OUTER JOIN comments c ON c.task_id = tasks.id
     WHERE
         {conditions}
-    GROUP BY tasks.id
+"""
+TASK_QUERY = TASK_SELECT + """
     ORDER BY n_incomplete_subtasks ASC
 """
+# Pages of the backlog, by id. Only tasks up to the id the first page was
+# rendered at are included, as later ones are added to the page on creation.
+BACKLOG_PAGE_QUERY = TASK_SELECT.format(
+    conditions="""
+        tasks.location = 'backlog'
+        AND tasks.parent_task_id IS NULL
+        AND tasks.id > ? AND tasks.id <= ?
+    """
+) + """
+    ORDER BY tasks.id
+    LIMIT ?
+"""
+COMMENT_QUERY = """
+    SELECT
+        comments.id AS id,
+        comments.task_id AS task_id,
+        comments.text AS text,
+        comments.created_at AS created_at,
+        comments.rendered_html AS rendered_html,
+        u.id AS commenter_id,
+        u.name AS commenter_name,
+        u.avatar AS commenter_avatar
+    FROM comments
+    LEFT JOIN users u ON comments.commenter_id = u.id
+    WHERE
+        {conditions}
+"""
+
+
+@app.after_server_start
+async def render_missing_references(app):
+    app.add_task(rerender_missing())
+
+
+@app.after_server_start
+async def archive_old_tasks(app):
+    app.add_task(archive_graveyard())
+
+
+@app.on_request
+async def start_timings(request):
+    if INSTRUMENT:
+        request.ctx.timings = Timings()
+        current.set(request.ctx.timings)
 
 
 @app.on_request
@@ -83,11 +212,129 @@ async def check_login(request):
         return redirect("/login")
 
 
+@app.on_request
+async def start_profile(request):
+    """
+    Profile the request if it asks for it, or if it is sampled.
+
+    Only runs for requests that passed auth, as it comes after it.
+    """
+    requested = (
+        "X-Zutun-Profile" in request.headers
+        or "profile" in request.get_args(keep_blank_values=True)
+    )
+    request.ctx.profile = profiler.start(requested)
+
+
 def allow_logged_out(fn):
     fn._ignore_login_check = True
     return fn
 
 
+def conditional(expires=None):
+    """
+    Answer conditional GETs with 304 Not Modified if nothing was written since.
+
+    The ETag is derived from the global data version (bumped by triggers on
+    every write), the logged-in user and the code. Pages showing relative
+    times pass expires (in seconds) to go stale even without writes.
+    """
+
+    def decorator(fn):
+        @wraps(fn)
+        async def handler(request, *args, **kwargs):
+            row = await db.fetchone("SELECT data_version FROM state")
+            parts = [BUILD, row["data_version"], request.cookies.get("user", "")]
+            if expires:
+                parts.append(int(time.time() // expires))
+            etag = 'W/"{}"'.format("-".join(map(str, parts)))
+            if etag in request.headers.get("If-None-Match", ""):
+                return HTTPResponse(status=304, headers={"ETag": etag})
+            request.ctx.etag = etag
+            return await fn(request, *args, **kwargs)
+
+        return handler
+
+    return decorator
+
+
+@app.on_response
+async def add_etag(request, response):
+    etag = getattr(request.ctx, "etag", None)
+    if etag and response.status == 200:
+        response.headers["ETag"] = etag
+        response.headers["Cache-Control"] = "private, no-cache"
+
+
+@app.on_response
+async def compress_html(request, response):
+    if not (response.content_type or "").startswith("text/html"):
+        return
+    if response.status != 200 or "Content-Encoding" in response.headers:
+        return
+    streaming = getattr(request.ctx, "streaming", False)
+    if not streaming and len(response.body or b"") < MIN_SIZE:
+        return
+    response.headers["Vary"] = "Accept-Encoding"
+    encoding = negotiate(request.headers.get("Accept-Encoding"), COMPRESSORS)
+    if encoding is None:
+        return
+    response.headers["Content-Encoding"] = encoding
+    if streaming:
+        response.stream = CompressedStream(response.stream, encoding)
+    else:
+        response.body = compress(response.body, encoding)
+
+
+@app.on_response
+async def add_timings(request, response):
+    """
+    Report the request's timings, and append them to pages in debug mode.
+
+    Streamed pages send their headers before they are rendered, so there the
+    header only covers the handler up to that point.
+    """
+    timings = getattr(request.ctx, "timings", None)
+    if timings is None:
+        return
+    if INSTRUMENT == "debug" and b"</body>" in (response.body or b""):
+        footer = str(DebugFooter.from_timings(timings)).encode()
+        response.body = response.body.replace(b"</body>", footer + b"</body>", 1)
+    response.headers["Server-Timing"] = timings.server_timing()
+
+
+@app.on_response
+async def link_profile(request, response):
+    profile = getattr(request.ctx, "profile", None)
+    if profile is not None and profile.id is not None:
+        response.headers["X-Zutun-Profile"] = f"/debug/profiles/{profile.id}"
+
+
+@app.signal("http.lifecycle.response")
+async def stop_profile(request, response):
+    profile = getattr(request.ctx, "profile", None)
+    if profile is not None:
+        request.ctx.profile = None
+        profiler.stop(profile)
+
+
+@app.signal("http.lifecycle.response")
+async def log_timings(request, response):
+    timings = getattr(request.ctx, "timings", None)
+    if timings is None:
+        return
+    logger.info(
+        json.dumps(
+            {
+                "method": request.method,
+                "path": request.path,
+                "status": response.status,
+                **timings.as_dict(),
+            }
+        )
+    )
+
+
 @app.get("/login-as/<user>")
 @allow_logged_out
 async def login_as(request, user):
@@ -103,124 +350,266 @@ async def login_as(request, user):
     return response
 
 
-TASK_PATTERN = re.compile(r"#(\d+)\b")
-USER_PATTERN = re.compile(r"@(\d+)\b")
-
-
 def D(multival_dict):
     return {key: val[0] for key, val in multival_dict.items()}
 
 
-def scale_image(img, target_size):
+async def stream_html(request, page):
     """
-    Scale image to a fixed, square size.
+    Send a page as it is rendered.
 
-    When the original image isn't a square, take only the central, square
-    portion.
+    The document head and navbar go out as soon as they are rendered; the
+    rest follows in chunks of about STREAM_CHUNK_SIZE characters.
     """
-    max_size = max(img.size)
-    min_size = min(img.size)
-    x, y = img.size
-    x_diff, y_diff = (max_size - x) // 2, (max_size - y) // 2
-    return img.resize(
-        (
-            target_size,
-            target_size,
-        ),
-        box=(
-            0 + y_diff,
-            0 + x_diff,
-            min_size + y_diff,
-            min_size + x_diff,
-        ),
-    )
+    request.ctx.streaming = True
+    response = await request.respond(content_type="text/html; charset=utf-8")
+    buffer, size, flushed_head = [], 0, False
+    for piece in timed_iter("render", page.iter_render()):
+        buffer.append(piece)
+        size += len(piece)
+        if size >= STREAM_CHUNK_SIZE or (not flushed_head and "<main>" in piece):
+            await response.send("".join(buffer))
+            buffer, size, flushed_head = [], 0, True
+    timings = getattr(request.ctx, "timings", None)
+    if INSTRUMENT == "debug" and timings is not None:
+        buffer.append(str(DebugFooter.from_timings(timings)))
+    await response.send("".join(buffer))
+    await response.eof()
+
+
+def _storypoints_by_state(tasks, states=STATES):
+    storypoints = {state: 0 for state in states}
+    for task in tasks:
+        storypoints[task["state"]] += task["storypoints_sum"] or task["storypoints"]
+    return storypoints
 
 
-def _kanban_columns_from_tasks(tasks, parent_task=None):
+def _kanban_columns_from_tasks(tasks, row="top"):
     columns = {state: [] for state in STATES}
-    storypoints = {state: 0 for state in STATES}
     for task in tasks:
         columns[task["state"]].append(
             TaskCard.from_row(task, draggable=True),
         )
-        storypoints[task["state"]] += task["storypoints_sum"] or task["storypoints"]
-    result = KanbanColumns(
+    storypoints = _storypoints_by_state(tasks)
+    return KanbanColumns(
         [
             KanbanColumn(
                 name=state,
-                heading=f"<h4>{state} <small>({storypoints[state]})</small></h4><hr>",
-                items=columns[state] or NoTasksPlaceholder(),
+                row=row,
+                heading=KanbanHeading(
+                    row=row, state=state, storypoints=storypoints[state]
+                ),
+                items=columns[state],
             )
             for state in STATES
         ],
     )
-    if parent_task:
-        result = TaskRow.from_row(parent_task, items=result)
-    return result
 
 
-def _kanban_board_from_tasks(tasks):
-    parent_task_ids = [task["id"] for task in tasks if task["n_incomplete_subtasks"]]
-    if parent_task_ids:
-        subtasks = conn.execute(
-            TASK_QUERY.format(
-                conditions=f"""
-                    tasks.parent_task_id IN ({",".join("?" * len(parent_task_ids))})
-                """,
-            ),
-            parent_task_ids,
-        ).fetchall()
-    else:
-        subtasks = None
+def _kanban_rows(children, parent_task_id=None):
+    """
+    Render the children of a task as cards, except for those with open
+    subtasks, which get a (nested) swimlane of their own.
 
+    children maps task ids to their subtasks. Swimlanes of tasks missing from
+    it are left collapsed, to be loaded when opened.
+    """
+    tasks = children[parent_task_id]
     rows = [
         _kanban_columns_from_tasks(
-            [task for task in tasks if not task["n_incomplete_subtasks"]]
+            [task for task in tasks if not task["n_incomplete_subtasks"]],
+            row=parent_task_id or "top",
         )
     ]
     for task in tasks:
-        if task["n_incomplete_subtasks"]:
-            rows.append(
-                _kanban_columns_from_tasks(
-                    [
-                        subtask
-                        for subtask in subtasks
-                        if subtask["parent_task_id"] == task["id"]
-                    ],
-                    parent_task=task,
-                )
-            )
+        if not task["n_incomplete_subtasks"]:
+            continue
+        if task["id"] in children:
+            items = _kanban_rows(children, task["id"])
+        else:
+            items = None
+        rows.append(TaskRow.from_row(task, items=items))
     return rows
 
 
+async def _kanban_board(roots, params=(), root=None):
+    """
+    Load the tasks matching the roots condition and all their descendants in
+    one query, and render them as kanban rows.
+
+    root is the id of the task whose subtasks the roots are, if any.
+    """
+    tasks = await db.fetchall(
+        TASK_QUERY.format(
+            conditions=f"""
+                tasks.id IN (
+                    SELECT task_closure.descendant_id FROM task_closure
+                    JOIN tasks root ON root.id = task_closure.ancestor_id
+                    WHERE {roots}
+                )
+            """
+        ),
+        params,
+    )
+    children = defaultdict(list)
+    for task in tasks:
+        if task["id"] != root:
+            children[task["parent_task_id"]].append(task)
+    # The roots are keyed by their parent, which is root.
+    children[None] = children.pop(root, [])
+    return _kanban_rows(children)
+
+
 @app.get("/")
+@conditional()
 async def board(request):
-    user = conn.execute(
-        "SELECT * FROM users WHERE id=?", (int(request.cookies.get("user")),)
-    ).fetchone()
+    # Read before the tasks, so that the event stream can't miss a change.
+    last_change = await db.fetchone("SELECT MAX(seq) AS seq FROM changes")
+    user, tasks, _ = await asyncio.gather(
+        db.fetchone(
+            "SELECT * FROM users WHERE id=?", (int(request.cookies.get("user")),)
+        ),
+        db.fetchall(
+            TASK_QUERY.format(
+                conditions="""
+                    tasks.location = 'selected'
+                    AND tasks.parent_task_id IS NULL
+                """
+            ),
+        ),
+        forget_foreign_writes(),
+    )
+    page = Page(
+        title="zutun — Board",
+        body=Kanban(
+            # Swimlanes are only loaded when opened.
+            columns=_kanban_rows({None: tasks}),
+            since=last_change["seq"] or 0,
+        ),
+        logout=LogoutBar.from_user(user),
+    )
+    return await stream_html(request, page)
 
-    tasks = conn.execute(
+
+async def _board_event(change):
+    """Render a change as a server-sent event for the main board."""
+    fragments = await _board_fragments(change["task_id"])
+    if fragments is None:
+        return f"id: {change['seq']}\nevent: refresh\ndata:\n\n"
+    data = "".join(str(fragment) for fragment in fragments)
+    lines = "".join(f"data: {line}\n" for line in data.splitlines())
+    return f"id: {change['seq']}\n{lines}\n"
+
+
+async def _board_fragments(task_id):
+    """
+    Re-render the card of task on the main board, if it is shown there.
+
+    Returns None when the board's layout changed and it needs to reload.
+    """
+    if task_id is None:
+        return None
+    task = await db.fetchone(TASK_QUERY.format(conditions="tasks.id = ?"), (task_id,))
+    fragments = [OobDelete(id=f"task-card-{task_id}")]
+    if not task:
+        return fragments
+    ancestors = await db.fetchall(
         TASK_QUERY.format(
             conditions="""
-                tasks.location = 'selected'
-                AND tasks.parent_task_id IS NULL
+                tasks.id IN (
+                    SELECT ancestor_id FROM task_closure
+                    WHERE descendant_id = ? AND depth > 0
+                )
             """
         ),
-    ).fetchall()
-    page = Page(
-        title="zutun — Board",
-        body=Kanban(columns=_kanban_board_from_tasks(tasks)),
-        logout=LogoutBar(**user),
+        (task_id,),
     )
-    return html(str(page))
+    top = task
+    for ancestor in ancestors:
+        if not ancestor["parent_task_id"]:
+            top = ancestor
+    if top["parent_task_id"] or top["location"] != "selected":
+        return fragments
+    # Swimlanes appeared or disappeared.
+    if not all(ancestor["n_incomplete_subtasks"] for ancestor in ancestors):
+        return None
+    # Swimlane headers show rollups of their subtree.
+    headers = [TaskRowHeader.from_row(ancestor, oob=OOB) for ancestor in ancestors]
+    if task["n_incomplete_subtasks"]:
+        return [*headers, TaskRowHeader.from_row(task, oob=OOB)]
+    row, headings = await _kanban_row_fragments(None, task, STATES)
+    # The swimlanes the card is nested in, from the top row down.
+    by_id = {ancestor["id"]: ancestor for ancestor in ancestors}
+    rows = []
+    parent_id = task["parent_task_id"]
+    while parent_id in by_id:
+        rows.insert(0, parent_id)
+        parent_id = by_id[parent_id]["parent_task_id"]
+    return [
+        *fragments,
+        OobSwap(
+            swap=f"beforeend:#kanban-items-{row}-{task['state']}",
+            content=TaskCard.from_row(task, draggable=True),
+            rows=" ".join(map(str, rows)),
+        ),
+        *headings,
+        *headers,
+    ]
+
+
+@app.get("/tasks/<task_id>/swimlane")
+@conditional()
+async def swimlane(request, task_id: int):
+    tasks = await db.fetchall(
+        TASK_QUERY.format(conditions="tasks.parent_task_id = ?"), (task_id,)
+    )
+    return html("".join(str(row) for row in _kanban_rows({task_id: tasks}, task_id)))
+
+
+@app.get("/events")
+async def events(request):
+    """
+    Stream board updates as server-sent events.
+
+    Clients resume from Last-Event-ID when they reconnect, or start from the
+    change the board was rendered at.
+    """
+    since = int(request.headers.get("Last-Event-ID") or request.args.get("since", 0))
+    response = await request.respond(
+        content_type="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
+    subscriber = feed.subscribe()
+    try:
+        oldest = await db.fetchone("SELECT MIN(seq) AS seq FROM changes")
+        if oldest["seq"] and since < oldest["seq"] - 1:
+            # The changes in between have been pruned already.
+            await response.send(f"id: {since}\nevent: refresh\ndata:\n\n")
+        while True:
+            subscriber.clear()
+            changes = await db.fetchall(
+                "SELECT seq, task_id FROM changes WHERE seq > ? ORDER BY seq LIMIT 100",
+                (since,),
+            )
+            for change in changes:
+                await response.send(await _board_event(change))
+                since = change["seq"]
+            if changes:
+                continue
+            try:
+                await asyncio.wait_for(subscriber.wait(), EVENTS_KEEPALIVE)
+            except asyncio.TimeoutError:
+                await response.send(": keepalive\n\n")
+    finally:
+        feed.unsubscribe(subscriber)
 
 
 @app.get("/login")
 @allow_logged_out
+@conditional()
 async def login(request):
     items = []
-    for row in conn.execute("SELECT * FROM users").fetchall():
-        items.append(UserChoice(**row))
+    for row in await db.fetchall("SELECT * FROM users"):
+        items.append(UserChoice.from_user(row))
     page = LoggedOutPage(
         title="zutun — Login",
         body=UserChoices(
@@ -230,116 +619,193 @@ async def login(request):
     return html(str(page))
 
 
+async def _backlog_page(after, until):
+    """
+    Fetch a page of backlog cards, followed by a loader for the next page.
+
+    The cards are only made while the page is rendered.
+    """
+    tasks = await db.fetchall(BACKLOG_PAGE_QUERY, (after, until, BACKLOG_PAGE_SIZE + 1))
+    return _backlog_items(tasks, until)
+
+
+def _backlog_items(tasks, until):
+    for task in tasks[:BACKLOG_PAGE_SIZE]:
+        yield TaskCard.from_row(task, with_select_button=True)
+    if len(tasks) > BACKLOG_PAGE_SIZE:
+        yield BacklogLoader(
+            after=tasks[BACKLOG_PAGE_SIZE - 1]["id"],
+            until=until,
+        )
+
+
 @app.get("/backlog")
+@conditional()
 async def backlog(request):
-    items = []
-    for i, t in enumerate(
-        conn.execute(
-            TASK_QUERY.format(
-                conditions="""
-                    tasks.location = 'backlog' AND tasks.parent_task_id IS NULL
-                """
-            ),
-        ).fetchall()
-    ):
-        items.append(
-            TaskCard.from_row(
-                t,
-                with_select_button=True,
-            )
-        )
-    user = conn.execute(
-        "SELECT * FROM users WHERE id=?", (int(request.cookies.get("user")),)
-    ).fetchone()
+    counts, user, _ = await asyncio.gather(
+        db.fetchone(
+            """
+            SELECT value AS n_items, (SELECT MAX(id) FROM tasks) AS until
+            FROM counters WHERE name = 'backlog'
+            """
+        ),
+        db.fetchone(
+            "SELECT * FROM users WHERE id=?", (int(request.cookies.get("user")),)
+        ),
+        forget_foreign_writes(),
+    )
     page = Page(
         title="zutun — Backlog",
         body=Backlog(
-            n_items=len(items),
-            items=items or NoTasksPlaceholder(),
+            count=BacklogCount(n_items=counts["n_items"]),
+            items=await _backlog_page(0, counts["until"] or 0),
         ),
-        logout=LogoutBar(**user),
+        logout=LogoutBar.from_user(user),
     )
-    return html(str(page))
+    return await stream_html(request, page)
+
+
+@app.get("/backlog/more")
+@conditional()
+async def backlog_more(request):
+    args = D(request.args)
+    items = await _backlog_page(int(args["after"]), int(args["until"]))
+    return html("".join(str(item) for item in items))
+
+
+def _page_root(request):
+    """
+    Find out which board the requesting page shows.
+
+    Returns the id of the task whose subtasks the page shows as its top row,
+    or None for the main board.
+    """
+    path = urlparse(request.headers.get("HX-Current-URL", "")).path
+    _, _, task_id = path.partition("/tasks/")
+    return int(task_id) if task_id.isdigit() else None
+
+
+async def _kanban_row_fragments(root, task, states):
+    """
+    Find the kanban row task is shown in on the board of root, and re-render
+    the headings of the given columns in it.
+    """
+    if task["parent_task_id"] != root:
+        row, conditions, params = (
+            task["parent_task_id"],
+            "tasks.parent_task_id = ?",
+            (task["parent_task_id"],),
+        )
+    elif root:
+        row, conditions, params = "top", "tasks.parent_task_id = ?", (root,)
+    else:
+        row, conditions, params = (
+            "top",
+            "tasks.location = 'selected' AND tasks.parent_task_id IS NULL",
+            (),
+        )
+    tasks = await db.fetchall(
+        TASK_QUERY.format(
+            conditions=f"""
+                {conditions}
+                AND tasks.state IN ({",".join("?" * len(states))})
+            """
+        ),
+        (*params, *states),
+    )
+    # Tasks with open subtasks get a row of their own instead.
+    tasks = [t for t in tasks if not t["n_incomplete_subtasks"]]
+    storypoints = _storypoints_by_state(tasks, states)
+    return row, [
+        KanbanHeading(row=row, state=state, storypoints=storypoints[state], oob=OOB)
+        for state in states
+    ]
+
+
+def _oob_response(fragments, **headers):
+    return html("".join(str(fragment) for fragment in fragments), headers=headers)
 
 
 @app.put("/tasks/state")
 async def change_state(request):
     data = D(request.form)
     task_id = int(data["task"])
-    conn.execute("UPDATE tasks SET state=? WHERE id=?", (data["state"], task_id))
-    conn.commit()
-    return html("", headers={"HX-Refresh": "true"})
+
+    def update(cur):
+        old = cur.execute("SELECT state FROM tasks WHERE id=?", (task_id,)).fetchone()
+        cur.execute("UPDATE tasks SET state=? WHERE id=?", (data["state"], task_id))
+        record_change(cur, task_id)
+        return old["state"]
+
+    old_state = await db.transaction(update)
+    feed.publish()
+    invalidate_card(task_id)
+    task = await db.fetchone(TASK_QUERY.format(conditions="tasks.id = ?"), (task_id,))
+    if task["parent_task_id"] and (old_state == "Done") != (task["state"] == "Done"):
+        parent = await db.fetchone(
+            TASK_QUERY.format(conditions="tasks.id = ?"), (task["parent_task_id"],)
+        )
+        n_incomplete = parent["n_incomplete_subtasks"] or 0
+        if (task["state"] == "Done" and n_incomplete == 0) or (
+            old_state == "Done" and n_incomplete == 1
+        ):
+            # The parent's last open subtask was closed, or its first reopened,
+            # so its swimlane just disappeared or appeared.
+            return html("", headers={"HX-Refresh": "true"})
+    row, headings = await _kanban_row_fragments(
+        _page_root(request), task, sorted({old_state, task["state"]})
+    )
+    return _oob_response(
+        [
+            OobDelete(id=f"task-card-{task_id}"),
+            OobSwap(
+                swap=f"beforeend:#kanban-items-{row}-{task['state']}",
+                content=TaskCard.from_row(task, draggable=True),
+            ),
+            *headings,
+        ],
+        **{"HX-Reswap": "none"},
+    )
+
+
+async def _backlog_count():
+    row = await db.fetchone("SELECT value FROM counters WHERE name = 'backlog'")
+    return row["value"]
 
 
 @app.post("/tasks/<task_id>/select")
 async def select_task(request, task_id: int):
-    conn.execute("UPDATE tasks SET location='selected' WHERE id=?", (task_id,))
-    conn.commit()
-    return html("", headers={"HX-Refresh": "true"})
-
-
-def _replace_task_ref(match):
-    task = conn.execute(
-        "SELECT * FROM tasks WHERE id = ?", (int(match.group(1)),)
-    ).fetchone()
-    return str(TaskLink(**task))
-
-
-def _replace_user_ref(match):
-    user = conn.execute(
-        "SELECT * FROM users WHERE id = ?", (int(match.group(1)),)
-    ).fetchone()
-    return str(
-        User(
-            user_set="user-set",
-            name=user["name"],
-            avatar=user["avatar"],
-        )
+    def select(cur):
+        cur.execute("UPDATE tasks SET location='selected' WHERE id=?", (task_id,))
+        record_change(cur, task_id)
+
+    await db.transaction(select)
+    feed.publish()
+    return _oob_response(
+        [
+            OobDelete(id=f"task-card-{task_id}"),
+            BacklogCount(n_items=await _backlog_count(), oob=OOB),
+        ],
+        **{"HX-Reswap": "none"},
     )
 
 
-def replace_task_references(text):
-    if not text:
-        return text
-    return USER_PATTERN.sub(
-        _replace_user_ref, TASK_PATTERN.sub(_replace_task_ref, text)
+def _naturaltime(timestamp):
+    with span("naturaltime"):
+        return naturaltime(datetime.fromisoformat(timestamp))
+
+
+def _comment_from_row(comment, text):
+    return Comment(
+        id=comment["id"],
+        commenter=User.from_comment(comment),
+        created_at=comment["created_at"],
+        created_at_human=_naturaltime(comment["created_at"]),
+        text=text,
     )
 
 
-@app.get("/tasks/<task_id>")
-async def view_task(request, task_id: int):
-    task = conn.execute(
-        TASK_QUERY.format(conditions="tasks.id = ?"), (task_id,)
-    ).fetchone()
-    comments = conn.execute(
-        """
-        SELECT
-            comments.id AS id,
-            comments.task_id AS task_id,
-            comments.text AS text,
-            comments.created_at AS created_at,
-            u.id AS commenter_id,
-            u.name AS commenter_name,
-            u.avatar AS commenter_avatar
-        FROM comments
-        LEFT JOIN users u ON comments.commenter_id = u.id
-        WHERE task_id = ?
-    """,
-        (task_id,),
-    ).fetchall()
-    subtasks = conn.execute(
-        TASK_QUERY.format(
-            conditions="""
-                tasks.parent_task_id = ?
-            """
-        ),
-        (task_id,),
-    ).fetchall()
-    user = conn.execute(
-        "SELECT * FROM users WHERE id=?", (int(request.cookies.get("user")),)
-    ).fetchone()
-    if not task:
-        return redirect("/")
+def _task_properties(task, parent_task_link):
     props = [StateSelector.from_task(task)]
     if not task["parent_task_id"]:
         props.append(TaskProperty("Location", task["location"]))
@@ -350,32 +816,172 @@ async def view_task(request, task_id: int):
     if task["parent_task_id"]:
         props.append(
             TaskProperty(
-                "Parent task", replace_task_references(f"#{task['parent_task_id']}")
+                "Parent task",
+                parent_task_link,
             )
         )
+    return props
+
+
+@app.get("/tasks/<task_id>")
+@conditional(expires=60)
+async def view_task(request, task_id: int):
+    task, comments, subtasks, user = await asyncio.gather(
+        db.fetchone(TASK_QUERY.format(conditions="tasks.id = ?"), (task_id,)),
+        db.fetchall(COMMENT_QUERY.format(conditions="task_id = ?"), (task_id,)),
+        _kanban_board("root.parent_task_id = ?", (task_id,), root=task_id),
+        db.fetchone(
+            "SELECT * FROM users WHERE id=?", (int(request.cookies.get("user")),)
+        ),
+    )
+    if not task:
+        return redirect("/")
+    # Descriptions and comments are normally rendered when written; only
+    # rows that predate that are rendered here.
+    parent_task_link, description, *comment_texts = await replace_references(
+        [
+            f"#{task['parent_task_id']}" if task["parent_task_id"] else None,
+            task["description"] if task["rendered_html"] is None else None,
+            *(
+                comment["text"] if comment["rendered_html"] is None else None
+                for comment in comments
+            ),
+        ]
+    )
     page = Page(
         title=f"{task['id']} - {task['summary']}",
         body=TaskDetail(
             id=task["id"],
-            title=task["summary"],
-            description=Description(replace_task_references(task["description"])),
-            properties=props,
+            title=TaskTitle(id=task["id"], title=task["summary"]),
+            description=Description(coalesce(task["rendered_html"], description)),
+            properties=TaskProperties(_task_properties(task, parent_task_link)),
             comments=[
-                Comment(
-                    commenter=User.from_comment(comment),
-                    created_at=comment["created_at"],
-                    created_at_human=naturaltime(
-                        datetime.fromisoformat(comment["created_at"])
-                    ),
-                    text=replace_task_references(comment["text"]),
-                )
-                for comment in comments
+                _comment_from_row(comment, coalesce(comment["rendered_html"], text))
+                for comment, text in zip(comments, comment_texts)
             ],
-            subtasks=Subtasks(_kanban_board_from_tasks(subtasks)) if subtasks else None,
+            subtasks=Subtasks(subtasks) if task["n_subtasks"] else None,
         ),
-        logout=LogoutBar(**user),
+        logout=LogoutBar.from_user(user),
     )
-    return html(str(page))
+    return await stream_html(request, page)
+
+
+@app.get("/search")
+@conditional()
+async def search_tasks(request):
+    """
+    Search tasks and comments.
+
+    The first page comes wrapped in a results box; later pages replace the
+    "More results" button of the page before them.
+    """
+    text = request.args.get("q", "")
+    page = int(request.args.get("page", 0))
+    hits, more = await search(text, page)
+    fragments = [
+        SearchHit(
+            task_id=hit["task_id"], summary=hit["summary"], snippet=hit["snippet"]
+        )
+        for hit in hits
+    ]
+    if more:
+        fragments.append(
+            MoreSearchResults(query=urlencode({"q": text, "page": page + 1}))
+        )
+    if page:
+        return html("".join(str(fragment) for fragment in fragments))
+    if not text.strip():
+        return html("")
+    return html(str(SearchResults(hits=fragments or NoSearchResults())))
+
+
+def _graveyard_items(tasks, more):
+    items = [ArchivedTaskCard.from_row(task) for task in tasks]
+    if more:
+        items.append(GraveyardLoader(before=tasks[-1]["id"]))
+    return items
+
+
+@app.get("/graveyard")
+@conditional()
+async def graveyard(request):
+    (tasks, more), user = await asyncio.gather(
+        graveyard_page(),
+        db.fetchone(
+            "SELECT * FROM users WHERE id=?", (int(request.cookies.get("user")),)
+        ),
+    )
+    page = Page(
+        title="zutun — Graveyard",
+        body=Graveyard(items=_graveyard_items(tasks, more)),
+        logout=LogoutBar.from_user(user),
+    )
+    return await stream_html(request, page)
+
+
+@app.get("/graveyard/more")
+@conditional()
+async def graveyard_more(request):
+    tasks, more = await graveyard_page(int(D(request.args)["before"]))
+    return html("".join(str(item) for item in _graveyard_items(tasks, more)))
+
+
+@app.get("/debug/slow-queries")
+async def slow_queries_page(request):
+    user = await db.fetchone(
+        "SELECT * FROM users WHERE id=?", (int(request.cookies.get("user")),)
+    )
+    shapes = [
+        SlowQueryShape.from_shape(sql, durations, latest)
+        for sql, durations, latest in slow_queries.by_shape()
+    ]
+    page = Page(
+        title="zutun — Slow queries",
+        body=SlowQueries(
+            threshold=f"{slow_queries.threshold * 1000:g}",
+            shapes=shapes or [NoSlowQueries()],
+        ),
+        logout=LogoutBar.from_user(user),
+    )
+    return await stream_html(request, page)
+
+
+@app.get("/debug/profiles/<profile_id>")
+async def view_profile(request, profile_id):
+    stats = load_profile(profile_id)
+    if stats is None:
+        return text("No such profile (any more).", status=404)
+    args = D(request.args)
+    if args.get("format") == "prof":
+        return raw(
+            dump_stats(stats),
+            content_type="application/octet-stream",
+            headers={
+                "Content-Disposition": f'attachment; filename="{profile_id}.prof"'
+            },
+        )
+    sort = args.get("sort") if args.get("sort") in SORT_KEYS else "cumulative"
+    return text(format_stats(stats, sort, 60))
+
+
+@app.get("/debug/profile")
+async def view_sampled_profile(request):
+    stats, n_workers = load_sampled()
+    if stats is None:
+        return text("No requests sampled yet; see ZUTUN_PROFILE_EVERY.")
+    args = D(request.args)
+    sort = args.get("sort") if args.get("sort") in SORT_KEYS else "tottime"
+    return text(
+        f"Sampled requests of {n_workers} workers\n"
+        + format_stats(stats, sort, HOT_MODULES, 60)
+    )
+
+
+@app.post("/graveyard/<task_id>/unarchive")
+async def unarchive_task(request, task_id: int):
+    if not await unarchive(task_id):
+        return HTTPResponse(body="404 Not Found", status=404)
+    return html("")
 
 
 @app.get("/users/new")
@@ -398,21 +1004,62 @@ async def new_user_form(request):
 async def new_user(request):
     data = D(request.form)
     f = request.files["avatar"][0]
-    img = scale_image(Image.open(BytesIO(f.body)), 128)
-    io = BytesIO()
-    img.save(io, format="JPEG")
-    conn.execute(
-        "INSERT INTO users (name, avatar) VALUES (?, ?)",
-        (data["name"], f"data:jpg;base64,{base64.b64encode(io.getvalue()).decode()}"),
-    )
-    conn.commit()
-    return html("", headers={"HX-Refresh": "true"})
+    if len(f.body) > MAX_UPLOAD_BYTES:
+        return HTTPResponse(body="413 Payload Too Large", status=413)
+    try:
+        renditions = await process_avatar(f.body)
+    except (UnidentifiedImageError, Image.DecompressionBombError, MemoryError):
+        return HTTPResponse(body="400 Bad Request", status=400)
+
+    def insert(cur):
+        avatar = store_avatar(cur, renditions[128, "image/jpeg"], renditions=renditions)
+        cur.execute(
+            "INSERT INTO users (name, avatar) VALUES (?, ?)", (data["name"], avatar)
+        )
+        return {"id": cur.lastrowid, "name": data["name"], "avatar": avatar}
+
+    user = await db.transaction(insert)
+    # Earlier mentions of this user id can now be resolved.
+    request.app.add_task(rerender_dependents("user", user["id"]))
+    # Replaces the form with a login link for the new user.
+    return html(str(UserChoice.from_user(user)))
+
+
+@app.get("/avatars/<filename>")
+@allow_logged_out
+async def avatar(request, filename):
+    # Avatars are addressed by content hash, so they never change.
+    name, _, extension = filename.partition(".")
+    digest, _, size = name.partition("-")
+    headers = {
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "ETag": f'"{name}.{extension}"',
+    }
+    if request.headers.get("If-None-Match") == headers["ETag"]:
+        return HTTPResponse(status=304, headers=headers)
+    if size:
+        mime_types = {ext: mime_type for mime_type, ext in AVATAR_EXTENSIONS.items()}
+        row = await db.fetchone(
+            """
+            SELECT mime_type, data FROM avatar_renditions
+            WHERE hash = ? AND size = ? AND mime_type = ?
+            """,
+            (digest, size, mime_types.get(extension)),
+        )
+    else:
+        row = await db.fetchone(
+            "SELECT mime_type, data FROM avatars WHERE hash = ?", (digest,)
+        )
+    if not row:
+        return HTTPResponse(body="404 Not Found", status=404)
+    return raw(row["data"], content_type=row["mime_type"], headers=headers)
 
 
 @app.get("/tasks/new")
+@conditional()
 async def new_task_form(request):
     args = D(request.args)
-    users = conn.execute("SELECT id, name, avatar FROM users").fetchall()
+    users = await db.fetchall("SELECT id, name, avatar FROM users")
     return html(
         str(
             Dialog(
@@ -429,11 +1076,12 @@ async def new_task_form(request):
 
 
 @app.get("/tasks/<task_id>/edit")
+@conditional()
 async def edit_task_form(request, task_id: int):
-    task = conn.execute(
-        TASK_QUERY.format(conditions="tasks.id = ?"), (task_id,)
-    ).fetchone()
-    users = conn.execute("SELECT id, name, avatar FROM users").fetchall()
+    task, users = await asyncio.gather(
+        db.fetchone(TASK_QUERY.format(conditions="tasks.id = ?"), (task_id,)),
+        db.fetchall("SELECT id, name, avatar FROM users"),
+    )
     return html(
         str(
             Dialog(
@@ -442,9 +1090,9 @@ async def edit_task_form(request, task_id: int):
                     endpoint=f"/tasks/{task_id}/edit",
                     assignee_choices=[
                         AssigneeChoice(
-                            selected="selected"
-                            if user["id"] == task["assignee_id"]
-                            else "",
+                            selected=(
+                                "selected" if user["id"] == task["assignee_id"] else ""
+                            ),
                             **user,
                         )
                         for user in users
@@ -460,65 +1108,215 @@ async def edit_task_form(request, task_id: int):
 async def post_comment(request, task_id: int):
     user_id = int(request.cookies.get("user"))
     data = D(request.form)
-    conn.execute(
-        "INSERT INTO comments (task_id, text, commenter_id) VALUES (?, ?, ?)",
-        (
-            task_id,
-            data["comment"],
-            user_id,
-        ),
+    (rendered_html,) = await replace_references([data["comment"]])
+
+    def insert(cur):
+        cur.execute(
+            "INSERT INTO comments (task_id, text, commenter_id) VALUES (?, ?, ?)",
+            (
+                task_id,
+                data["comment"],
+                user_id,
+            ),
+        )
+        comment_id = cur.lastrowid
+        store_rendered(cur, "comment", comment_id, data["comment"], rendered_html)
+        record_change(cur, task_id)
+        return comment_id
+
+    comment_id = await db.transaction(insert)
+    feed.publish()
+    invalidate_card(task_id)
+    comment = await db.fetchone(
+        COMMENT_QUERY.format(conditions="comments.id = ?"), (comment_id,)
+    )
+    return _oob_response(
+        [
+            OobSwap(
+                swap="beforeend:#comments",
+                content=_comment_from_row(comment, comment["rendered_html"]),
+            ),
+        ],
+        **{"HX-Reswap": "none"},
     )
-    conn.commit()
-    return html("", headers={"HX-Refresh": "true"})
 
 
 @app.post("/tasks/<task_id>/edit")
 async def edit_task(request, task_id: int):
     data = D(request.form)
-    conn.execute(
-        "UPDATE tasks SET summary=?, description=?, assignee_id=?, storypoints=?, parent_task_id=? WHERE id=?",
-        (
-            data["summary"],
-            data.get("description"),
-            data.get("assignee_id") or None,
-            data.get("storypoints"),
-            data.get("parent_task_id"),
-            task_id,
-        ),
+    (rendered_html,) = await replace_references([data.get("description")])
+
+    def update(cur):
+        old = cur.execute(
+            "SELECT summary, parent_task_id FROM tasks WHERE id=?", (task_id,)
+        ).fetchone()
+        # A task can't become a subtask of itself or of its own subtasks.
+        if cur.execute(
+            "SELECT 1 FROM task_closure WHERE ancestor_id = ? AND descendant_id = ?",
+            (task_id, data.get("parent_task_id")),
+        ).fetchone():
+            return None
+        cur.execute(
+            "UPDATE tasks SET summary=?, description=?, assignee_id=?, storypoints=?, parent_task_id=? WHERE id=?",
+            (
+                data["summary"],
+                data.get("description"),
+                data.get("assignee_id") or None,
+                data.get("storypoints"),
+                data.get("parent_task_id"),
+                task_id,
+            ),
+        )
+        store_rendered(cur, "task", task_id, data.get("description"), rendered_html)
+        # Parents show their subtasks' storypoints and counts.
+        new_parent_task_id = int(data.get("parent_task_id") or 0)
+        changed_ids = {task_id, old["parent_task_id"], new_parent_task_id} - {None, 0}
+        for changed_id in changed_ids:
+            record_change(cur, changed_id)
+        return changed_ids, old["summary"] != data["summary"]
+
+    result = await db.transaction(update)
+    if result is None:
+        return HTTPResponse(body="400 Bad Request", status=400)
+    changed_ids, summary_changed = result
+    for changed_id in changed_ids:
+        invalidate_card(changed_id)
+    feed.publish()
+    # References to the task only show its summary.
+    if summary_changed:
+        invalidate_task(task_id)
+        request.app.add_task(rerender_dependents("task", task_id))
+    task = await db.fetchone(TASK_QUERY.format(conditions="tasks.id = ?"), (task_id,))
+    (parent_task_link,) = await replace_references(
+        [f"#{task['parent_task_id']}" if task["parent_task_id"] else None]
+    )
+    # The edit dialog is closed by swapping the (empty) main content into
+    # its holder.
+    return _oob_response(
+        [
+            TaskTitle(id=task["id"], title=task["summary"], oob=OOB),
+            Description(task["rendered_html"], oob=OOB),
+            TaskProperties(_task_properties(task, parent_task_link), oob=OOB),
+        ],
+        **{"HX-Retarget": "#popoverholder", "HX-Reswap": "innerHTML"},
     )
-    conn.commit()
-    return html("", headers={"HX-Refresh": "true"})
 
 
 @app.post("/finish-sprint")
 async def finish_sprint(request):
-    cur = conn.cursor()
-    cur.execute(
-        "UPDATE tasks SET location='graveyard' WHERE location = 'selected' AND state = 'Done'"
-    )
-    cur.execute(
-        "UPDATE tasks SET location='backlog' WHERE location = 'selected' AND state <> 'Done'"
-    )
-    conn.commit()
+    def finish(cur):
+        # Subtasks go wherever their top-level task goes.
+        for location, condition in [
+            ("graveyard", "root.state = 'Done'"),
+            ("backlog", "root.state <> 'Done'"),
+        ]:
+            cur.execute(
+                f"""
+                UPDATE tasks SET location = ?
+                WHERE id IN (
+                    SELECT task_closure.descendant_id FROM task_closure
+                    JOIN tasks root ON root.id = task_closure.ancestor_id
+                    WHERE root.location = 'selected'
+                    AND root.parent_task_id IS NULL
+                    AND {condition}
+                )
+                """,
+                (location,),
+            )
+        record_change(cur)
+
+    await db.transaction(finish)
+    feed.publish()
+    request.app.add_task(archive_graveyard())
     return html("", headers={"HX-Location": "/backlog"})
 
 
 @app.post("/tasks/new")
 async def new_task(request):
     data = D(request.form)
-    conn.execute(
-        "INSERT INTO tasks (summary, description, assignee_id, storypoints, parent_task_id, state, location) VALUES (?, ?, ?, ?, ?, 'ToDo', ?)",
-        (
-            data["summary"],
-            data.get("description"),
-            data.get("assignee_id") or None,
-            data.get("storypoints"),
-            data.get("parent_task_id"),
-            "selected" if data.get("selected") else "backlog",
-        ),
+    (rendered_html,) = await replace_references([data.get("description")])
+
+    def insert(cur):
+        cur.execute(
+            # Ids of archived tasks must not be reused, or unarchiving them
+            # would clash.
+            """
+            INSERT INTO tasks (id, summary, description, assignee_id, storypoints, parent_task_id, state, location)
+            VALUES (
+                (
+                    SELECT MAX(id) + 1 FROM (
+                        SELECT MAX(id) AS id FROM tasks
+                        UNION ALL
+                        SELECT MAX(id) FROM archived_tasks
+                    )
+                ),
+                ?, ?, ?, ?, ?, 'ToDo', ?
+            )
+            """,
+            (
+                data["summary"],
+                data.get("description"),
+                data.get("assignee_id") or None,
+                data.get("storypoints"),
+                data.get("parent_task_id"),
+                "selected" if data.get("selected") else "backlog",
+            ),
+        )
+        task_id = cur.lastrowid
+        store_rendered(cur, "task", task_id, data.get("description"), rendered_html)
+        record_change(cur, task_id)
+        if data.get("parent_task_id"):
+            record_change(cur, int(data["parent_task_id"]))
+        return task_id
+
+    task_id = await db.transaction(insert)
+    feed.publish()
+    if data.get("parent_task_id"):
+        invalidate_card(data["parent_task_id"])
+    # Earlier mentions of this task id can now be resolved.
+    request.app.add_task(rerender_dependents("task", task_id))
+    task = await db.fetchone(TASK_QUERY.format(conditions="tasks.id = ?"), (task_id,))
+    path = urlparse(request.headers.get("HX-Current-URL", "")).path
+    root = _page_root(request)
+    if root and task["parent_task_id"] == root:
+        parent = await db.fetchone(
+            TASK_QUERY.format(conditions="tasks.id = ?"), (root,)
+        )
+        # Otherwise the page has no subtask board to add the card to yet.
+        on_board = parent["n_subtasks"] > 1
+    else:
+        on_board = (
+            path == "/"
+            and task["location"] == "selected"
+            and not task["parent_task_id"]
+        )
+    if on_board:
+        row, headings = await _kanban_row_fragments(root, task, ["ToDo"])
+        fragments = [
+            OobSwap(
+                swap=f"beforeend:#kanban-items-{row}-ToDo",
+                content=TaskCard.from_row(task, draggable=True),
+            ),
+            *headings,
+        ]
+    elif (
+        path == "/backlog"
+        and task["location"] == "backlog"
+        and not task["parent_task_id"]
+    ):
+        fragments = [
+            OobSwap(
+                swap="beforeend:#backlog-items",
+                content=TaskCard.from_row(task, with_select_button=True),
+            ),
+            BacklogCount(n_items=await _backlog_count(), oob=OOB),
+        ]
+    else:
+        return html("", headers={"HX-Refresh": "true"})
+    # Closes the dialog, like edit_task does.
+    return _oob_response(
+        fragments, **{"HX-Retarget": "#popoverholder", "HX-Reswap": "innerHTML"}
     )
-    conn.commit()
-    return html("", headers={"HX-Refresh": "true"})
 
 
 @app.get("/blank")
@@ -526,25 +1324,54 @@ async def blank(request):
     return html("")
 
 
+def _asset_response(request, asset, cache_control):
+    headers = {
+        "Cache-Control": cache_control,
+        "ETag": f'"{asset.hash}"',
+        "Vary": "Accept-Encoding",
+    }
+    if request.headers.get("If-None-Match") == headers["ETag"]:
+        return HTTPResponse(status=304, headers=headers)
+    body, encoding = asset.body(request.headers.get("Accept-Encoding"))
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return raw(body, content_type=asset.mime_type, headers=headers)
+
+
+@app.get("/static/<digest>/<name>")
+@allow_logged_out
+async def static(request, digest, name):
+    asset = assets.get(name)
+    if asset is None:
+        return HTTPResponse(body="404 Not Found", status=404)
+    if digest != asset.hash:
+        # Asked for by a page rendered before the asset changed.
+        return redirect(asset.url)
+    return _asset_response(request, asset, "public, max-age=31536000, immutable")
+
+
+# The unversioned URLs, for anything that still links to them.
+
+
 @app.get("/pico.min.css")
 @allow_logged_out
 async def pico_css(request):
-    return await file("pico.min.css", mime_type="text/css")
+    return _asset_response(request, assets["pico.min.css"], "no-cache")
 
 
 @app.get("/style.css")
 @allow_logged_out
 async def style_css(request):
-    return await file("style.css", mime_type="text/css")
+    return _asset_response(request, assets["style.css"], "no-cache")
 
 
 @app.get("/htmx.js")
 @allow_logged_out
 async def htmx_js(request):
-    return await file("htmx.js", mime_type="text/javascript")
+    return _asset_response(request, assets["htmx.js"], "no-cache")
 
 
 @app.get("/hx-drag.js")
 @allow_logged_out
 async def hx_drag_js(request):
-    return await file("hx-drag.js", mime_type="text/javascript")
+    return _asset_response(request, assets["hx-drag.js"], "no-cache")
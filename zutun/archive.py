@@ -0,0 +1,159 @@
+from zutun.db import db
+from zutun.references import rerender
+
+
+# Top-level tasks (with all their subtasks) moved per transaction, so that
+# archiving doesn't hold up other writes for long.
+ARCHIVE_BATCH_SIZE = 100
+GRAVEYARD_PAGE_SIZE = 50
+TASK_COLUMNS = """
+    id, summary, description, state, storypoints, parent_task_id, assignee_id,
+    rendered_html
+"""
+COMMENT_COLUMNS = "task_id, text, created_at, commenter_id, rendered_html"
+GRAVEYARD_PAGE_QUERY = """
+    SELECT
+        archived_tasks.id AS id,
+        archived_tasks.summary AS summary,
+        archived_tasks.rendered_html AS rendered_html,
+        COALESCE(archived_tasks.storypoints, 0) AS storypoints,
+        archived_tasks.archived_at AS archived_at,
+        (
+            SELECT COUNT(*) FROM archived_tasks subtask
+            WHERE subtask.parent_task_id = archived_tasks.id
+        ) AS n_subtasks,
+        (
+            SELECT COUNT(*) FROM archived_comments c
+            WHERE c.task_id = archived_tasks.id
+        ) AS n_comments
+    FROM archived_tasks
+    WHERE archived_tasks.parent_task_id IS NULL AND archived_tasks.id < ?
+    ORDER BY archived_tasks.id DESC
+    LIMIT ?
+"""
+
+
+def _archive_batch(cur):
+    """
+    Move a batch of top-level graveyard tasks, their subtasks and all their
+    comments into the archive.
+
+    Returns the number of tasks moved.
+    """
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS archiving (id INTEGER PRIMARY KEY)")
+    cur.execute("DELETE FROM temp.archiving")
+    cur.execute(
+        """
+        INSERT INTO temp.archiving (id)
+        SELECT descendant_id FROM task_closure
+        WHERE ancestor_id IN (
+            SELECT id FROM tasks
+            WHERE location = 'graveyard' AND parent_task_id IS NULL
+            LIMIT ?
+        )
+        """,
+        (ARCHIVE_BATCH_SIZE,),
+    )
+    if not cur.rowcount:
+        return 0
+    cur.execute(f"""
+        INSERT INTO archived_tasks ({TASK_COLUMNS})
+        SELECT {TASK_COLUMNS} FROM tasks WHERE id IN temp.archiving
+    """)
+    cur.execute(f"""
+        INSERT INTO archived_comments (original_id, {COMMENT_COLUMNS})
+        SELECT id, {COMMENT_COLUMNS} FROM comments WHERE task_id IN temp.archiving
+        ORDER BY id
+    """)
+    cur.execute("""
+        DELETE FROM reference_deps
+        WHERE (source_kind = 'task' AND source_id IN temp.archiving)
+        OR (
+            source_kind = 'comment'
+            AND source_id IN (
+                SELECT id FROM comments WHERE task_id IN temp.archiving
+            )
+        )
+    """)
+    cur.execute("DELETE FROM comments WHERE task_id IN temp.archiving")
+    cur.execute("DELETE FROM tasks WHERE id IN temp.archiving")
+    return cur.rowcount
+
+
+async def archive_graveyard():
+    """Move all graveyard tasks into the archive, one batch at a time."""
+    while await db.transaction(_archive_batch):
+        pass
+
+
+def _unarchive(cur, task_id):
+    """
+    Move an archived top-level task and its subtasks back into the backlog.
+
+    Returns the ids of the moved tasks and of their comments. Comments get new
+    ids, as theirs may have been reused since.
+    """
+    subtree = """
+        WITH RECURSIVE subtree(id, depth) AS (
+            SELECT id, 0 FROM archived_tasks
+            WHERE id = ? AND parent_task_id IS NULL
+            UNION ALL
+            SELECT archived_tasks.id, subtree.depth + 1 FROM archived_tasks
+            JOIN subtree ON archived_tasks.parent_task_id = subtree.id
+        )
+    """
+    task_ids = [
+        row["id"]
+        for row in cur.execute(subtree + "SELECT id FROM subtree", (task_id,))
+    ]
+    if not task_ids:
+        return [], []
+    cur.execute("CREATE TEMP TABLE IF NOT EXISTS unarchiving (id INTEGER PRIMARY KEY)")
+    cur.execute("DELETE FROM temp.unarchiving")
+    cur.executemany(
+        "INSERT INTO temp.unarchiving (id) VALUES (?)", [(id,) for id in task_ids]
+    )
+    # Parents first, so the triggers can fill in the closure table.
+    cur.execute(
+        subtree
+        + f"""
+        INSERT INTO tasks ({TASK_COLUMNS}, location)
+        SELECT {TASK_COLUMNS}, 'backlog' FROM archived_tasks
+        JOIN subtree USING (id)
+        ORDER BY subtree.depth
+        """,
+        (task_id,),
+    )
+    comment_ids = []
+    for comment in cur.execute(f"""
+        SELECT {COMMENT_COLUMNS} FROM archived_comments
+        WHERE task_id IN temp.unarchiving
+        ORDER BY id
+    """).fetchall():
+        cur.execute(
+            f"INSERT INTO comments ({COMMENT_COLUMNS}) VALUES (?, ?, ?, ?, ?)",
+            tuple(comment),
+        )
+        comment_ids.append(cur.lastrowid)
+    cur.execute("DELETE FROM archived_comments WHERE task_id IN temp.unarchiving")
+    cur.execute("DELETE FROM archived_tasks WHERE id IN temp.unarchiving")
+    return task_ids, comment_ids
+
+
+async def unarchive(task_id):
+    """Move an archived task back into the backlog; returns whether it existed."""
+    task_ids, comment_ids = await db.transaction(lambda cur: _unarchive(cur, task_id))
+    # Restores what the references of these depend on.
+    await rerender(
+        [("task", id) for id in task_ids] + [("comment", id) for id in comment_ids]
+    )
+    return bool(task_ids)
+
+
+async def graveyard_page(before=float("inf")):
+    """
+    Return a page of archived top-level tasks with ids below before, newest
+    first, and whether there are more.
+    """
+    tasks = await db.fetchall(GRAVEYARD_PAGE_QUERY, (before, GRAVEYARD_PAGE_SIZE + 1))
+    return tasks[:GRAVEYARD_PAGE_SIZE], len(tasks) > GRAVEYARD_PAGE_SIZE
@@ -0,0 +1,53 @@
+import hashlib
+
+from zutun.compression import COMPRESSORS, MAX_LEVELS, compress, negotiate
+
+
+# Served from memory at /static/<hash>/<name>, relative to the working
+# directory like before.
+ASSETS = {
+    "pico.min.css": "text/css",
+    "style.css": "text/css",
+    "htmx.js": "text/javascript",
+    "hx-drag.js": "text/javascript",
+}
+
+
+class Asset:
+    def __init__(self, name, mime_type, data):
+        self.name = name
+        self.mime_type = mime_type
+        self.hash = hashlib.sha256(data).hexdigest()[:16]
+        self.url = f"/static/{self.hash}/{name}"
+        self.data = data
+        # Only kept where compressing actually saves something.
+        self.encoded = {}
+        for encoding in COMPRESSORS:
+            encoded = compress(data, encoding, MAX_LEVELS[encoding])
+            if len(encoded) < len(data):
+                self.encoded[encoding] = encoded
+
+    def body(self, accept_encoding):
+        """Return the body and its Content-Encoding (or None) for a client."""
+        encoding = negotiate(accept_encoding, self.encoded)
+        if encoding is None:
+            return self.data, None
+        return self.encoded[encoding], encoding
+
+
+def load_assets():
+    assets = {}
+    for name, mime_type in ASSETS.items():
+        with open(name, "rb") as f:
+            assets[name] = Asset(name, mime_type, f.read())
+    return assets
+
+
+assets = load_assets()
+
+
+def fingerprint_urls(template):
+    """Point references to assets in a template at their content-hash URLs."""
+    for asset in assets.values():
+        template = template.replace(f'"/{asset.name}"', f'"{asset.url}"')
+    return template
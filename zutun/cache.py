@@ -0,0 +1,32 @@
+from collections import OrderedDict
+
+
+# Every cache, so that all of them can be dropped at once.
+caches = []
+
+
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        caches.append(self)
+
+    def get(self, key):
+        try:
+            self.items.move_to_end(key)
+        except KeyError:
+            return None
+        return self.items[key]
+
+    def __setitem__(self, key, value):
+        self.items[key] = value
+        self.items.move_to_end(key)
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def invalidate(self, key):
+        self.items.pop(key, None)
+
+    def clear(self):
+        self.items.clear()
+
@@ -0,0 +1,47 @@
+import asyncio
+
+
+# Only this many changes are kept; clients that fall further behind than that
+# have to reload.
+MAX_CHANGES = 10_000
+
+
+def record_change(cur, task_id=None):
+    """
+    Record that a task changed, as part of the current write transaction.
+
+    A task_id of None means that too much changed to describe, and that
+    clients should reload.
+    """
+    cur.execute("INSERT INTO changes (task_id) VALUES (?)", (task_id,))
+    cur.execute(
+        "DELETE FROM changes WHERE seq <= ?", (cur.lastrowid - MAX_CHANGES,)
+    )
+
+
+class ChangeFeed:
+    """
+    Wakes up /events streams in this process when something was written.
+
+    The changes themselves live in the changes table, which is what the
+    streams read; the feed only spares them from polling it. Writes by other
+    workers are picked up when a stream's wait times out.
+    """
+
+    def __init__(self):
+        self.subscribers = set()
+
+    def subscribe(self):
+        subscriber = asyncio.Event()
+        self.subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    def publish(self):
+        for subscriber in self.subscribers:
+            subscriber.set()
+
+
+feed = ChangeFeed()
@@ -1,7 +1,49 @@
+import re
+from html import escape
+from types import GeneratorType
+from string import Formatter
 from collections import defaultdict
 
+from zutun.cache import LRUCache
+from zutun.instrumentation import current as current_timings, span, percentile
+
 
 STATES = ["ToDo", "Ongoing", "Blocked", "Done"]
+# Marks a fragment for an htmx out-of-band swap of the element with its id.
+OOB = 'hx-swap-oob="true"'
+# Indentation and blank lines around the markup in component templates.
+TEMPLATE_WHITESPACE = re.compile(r"\s*\n\s*")
+
+
+# Rendered task cards and swimlane headers, keyed by task id. Each entry holds
+# the version of the row it was rendered from, and every variant rendered since.
+cards = LRUCache(maxsize=4096)
+# Everything shown on a card; the assignee's name and avatar are covered by
+# their user version.
+CARD_VERSION_COLUMNS = [
+    "version",
+    "assignee_version",
+    "storypoints_sum",
+    "n_open_descendants",
+    "n_subtasks",
+    "n_comments",
+]
+
+
+def cached_card(row, variant, render):
+    """Return the cached HTML of a variant of a task's card, or render it."""
+    version = tuple(row[column] for column in CARD_VERSION_COLUMNS)
+    entry = cards.get(row["id"])
+    if entry is None or entry[0] != version:
+        entry = cards[row["id"]] = (version, {})
+    html = entry[1].get(variant)
+    if html is None:
+        html = entry[1][variant] = str(render())
+    return html
+
+
+def invalidate_card(task_id):
+    cards.invalidate(int(task_id))
 
 
 def coalesce(*args):
@@ -10,21 +52,79 @@ def coalesce(*args):
             return arg
 
 
-class Component:
+def parse_template(template):
+    """
+    Split a str.format-style template into (literal, slot) pairs.
+
+    Runs of whitespace containing a line break are collapsed into a single
+    line break, which keeps the markup equivalent but the responses smaller.
+    """
+    return [
+        (TEMPLATE_WHITESPACE.sub("\n", literal), slot)
+        for literal, slot, _, _ in Formatter().parse(template)
+    ]
+
+
+def compile_template(parts):
+    """
+    Compile a parsed template into a render function.
+
+    The returned function takes a slot lookup and a stringifier and renders
+    everything with a single ''.join.
+    """
+    pieces = []
+    for literal, slot in parts:
+        if literal:
+            pieces.append(repr(literal))
+        if slot is not None:
+            pieces.append(f"stringify(get({slot!r}, ''))")
+    namespace = {}
+    exec(
+        f"def render(get, stringify):\n    return ''.join([{', '.join(pieces)}])",
+        namespace,
+    )
+    return namespace["render"]
+
+
+class ComponentType(type):
+    """Compiles each component's docstring template when the class is made."""
+
+    def __new__(mcs, name, bases, namespace):
+        namespace.setdefault("__slots__", ())
+        cls = super().__new__(mcs, name, bases, namespace)
+        cls._compile()
+        return cls
+
+    def __setattr__(cls, name, value):
+        super().__setattr__(name, value)
+        if name == "__doc__":
+            cls._compile()
+
+    def _compile(cls):
+        parts = parse_template(cls.__doc__ or "")
+        cls._parts = parts
+        cls._render = staticmethod(compile_template(parts))
+
+
+class Component(metaclass=ComponentType):
+    __slots__ = ("kwargs",)
     sep = ""
     default = defaultdict(str)
 
     def __init__(self, *args, **kwargs):
-        self.kwargs = defaultdict(
-            str,
-            {
+        default = self.default
+        for k, v in kwargs.items():
+            if v is None:
+                kwargs[k] = default[k]
+        if args:
+            kwargs = {
                 **{
-                    f"_{i}": coalesce(arg, self.default[i])
+                    f"_{i}": default[i] if arg is None else arg
                     for i, arg in enumerate(args)
                 },
-                **{k: coalesce(v, self.default[k]) for k, v in kwargs.items()},
-            },
-        )
+                **kwargs,
+            }
+        self.kwargs = kwargs
 
     def __repr__(self):
         parts = []
@@ -34,14 +134,60 @@ class Component:
             f"""<{self.__class__.__name__}{f" {' '.join(parts)}" if parts else ""}>"""
         )
 
+    def _stringify(self, value):
+        if isinstance(value, (list, GeneratorType)):
+            return self.sep.join([str(element) for element in value])
+        return str(value)
+
     def __str__(self):
-        t_kwargs = {}
-        for slot, value in self.kwargs.items():
-            if isinstance(value, list):
-                t_kwargs[slot] = self.sep.join(str(element) for element in value)
+        if current_timings.get() is None:
+            return self._render(self.kwargs.get, self._stringify)
+        with span("render"):
+            return self._render(self.kwargs.get, self._stringify)
+
+    def iter_render(self):
+        """
+        Render like str(), but yield the output piece by piece.
+
+        Slots may hold generators, whose elements are then only created while
+        the output is consumed.
+        """
+        get = self.kwargs.get
+        for literal, slot in self._parts:
+            if literal:
+                yield literal
+            if slot is None:
+                continue
+            value = get(slot, "")
+            if isinstance(value, (list, GeneratorType)):
+                for i, element in enumerate(value):
+                    if i:
+                        yield self.sep
+                    yield from _iter_render(element)
             else:
-                t_kwargs[slot] = str(value)
-        return self.__doc__.format_map(defaultdict(str, t_kwargs))
+                yield from _iter_render(value)
+
+
+def _iter_render(value):
+    if isinstance(value, Component):
+        return value.iter_render()
+    return (str(value),)
+
+
+class CachedCard(Component):
+    # A variant of a task's card, which is only looked up in the cache (and
+    # rendered, if need be) when it is itself rendered. Built eagerly, cards
+    # would all be rendered before a streamed page sends its first byte.
+    # (No docstring, as that would be the template.)
+
+    def __init__(self, row, variant, render):
+        self.kwargs = {"row": row, "variant": variant, "render": render}
+
+    def __str__(self):
+        return cached_card(**self.kwargs)
+
+    def iter_render(self):
+        yield str(self)
 
 
 class Kanban(Component):
@@ -53,6 +199,36 @@ class Kanban(Component):
     <article>
     {columns}
     </article>
+    <script>
+    (() => {{
+        const events = new EventSource("/events?since={since}");
+        events.onmessage = (event) => htmx.swap("body", event.data, {{swapStyle: "none"}});
+        events.addEventListener("refresh", () => location.reload());
+        // A card was added to a swimlane this board doesn't show yet. data-rows
+        // lists the swimlanes from the top row down to the card's. Collapsed
+        // ones are loaded fresh when opened, so cards inside them can be
+        // skipped; only a missing row below open ones means the board is off.
+        document.body.addEventListener("htmx:oobErrorNoTarget", (event) => {{
+            const content = event.detail.content;
+            const swap = content.getAttribute("hx-swap-oob");
+            const row = swap.match(/^beforeend:#kanban-items-(\\w+)-/);
+            if (!row) {{
+                return;
+            }}
+            const rows = content.dataset.rows ? content.dataset.rows.split(" ") : [row[1]];
+            for (const id of rows) {{
+                const element = document.getElementById("task-row-" + id);
+                if (!element) {{
+                    location.reload();
+                    return;
+                }}
+                if (!element.querySelector("details").open) {{
+                    return;
+                }}
+            }}
+        }});
+    }})();
+    </script>
     """
 
 
@@ -76,11 +252,19 @@ class KanbanColumns(Component):
 class UserChoice(Component):
     """
     <div class="user-card">
-      <img class="avatar" src="{avatar}">
+      {avatar}
       <a href="/login-as/{id}"><strong>{name}</strong></a><br>
     </div>
     """
 
+    @classmethod
+    def from_user(cls, user):
+        return cls(
+            id=user["id"],
+            name=user["name"],
+            avatar=Avatar.from_url(user["avatar"]),
+        )
+
 
 class UserChoices(Component):
     """
@@ -100,35 +284,97 @@ class UserChoices(Component):
 
 class Backlog(Component):
     """
-    <h2>Backlog <small>({n_items})</small></h2>
-    <article class="backlog">
+    <h2>Backlog {count}</h2>
+    <article class="backlog" id="backlog-items">
+      {items}
+    </article>
+    """
+
+
+class BacklogLoader(Component):
+    """
+    <div hx-get="/backlog/more?after={after}&until={until}" hx-trigger="revealed" hx-swap="outerHTML">
+        <span aria-busy="true">Loading more tasks…</span>
+    </div>
+    """
+
+
+class Graveyard(Component):
+    """
+    <h2>Graveyard</h2>
+    <article class="graveyard">
       {items}
     </article>
     """
 
 
-class NoTasksPlaceholder(Component):
+class ArchivedTaskCard(Component):
+    """
+    <article class="task-card" id="archived-task-{id}">
+      <button hx-post="/graveyard/{id}/unarchive" hx-target="#archived-task-{id}" hx-swap="delete">Unarchive</button>
+      <details>
+        <summary><span class="id">{id}</span> <strong>{summary}</strong></summary>
+        {description}
+      </details>
+      <small>{details}</small>
+    </article>
     """
-    <div class="no-tasks-placeholder">
-      (No tasks here)
+
+    @classmethod
+    def from_row(cls, row):
+        details = [Storypoints(row["storypoints"]), f"archived {row['archived_at']}"]
+        if row["n_subtasks"]:
+            details.append(f"{row['n_subtasks']} subtasks")
+        if row["n_comments"]:
+            details.append(f"{row['n_comments']} 💬")
+        return cls(
+            id=row["id"],
+            summary=row["summary"],
+            description=row["rendered_html"],
+            details=details,
+        )
+
+    sep = " · "
+
+
+class GraveyardLoader(Component):
+    """
+    <div hx-get="/graveyard/more?before={before}" hx-trigger="revealed" hx-swap="outerHTML">
+        <span aria-busy="true">Loading more tasks…</span>
     </div>
     """
 
 
+class BacklogCount(Component):
+    """<small id="backlog-count" {oob}>({n_items})</small>"""
+
+
 class KanbanColumn(Component):
     """
     <div class="kanban-col kanban-col-{name}">
-      {heading}
-      <div class="kanban-col-items" hx-drop='{{"state": "{name}"}}' hx-drop-action="/tasks/state">
+      {heading}<hr>
+      <div class="kanban-col-items" id="kanban-items-{row}-{name}" hx-drop='{{"state": "{name}"}}' hx-drop-action="/tasks/state">
         {items}
       </div>
     </div>
     """
 
 
+class KanbanHeading(Component):
+    """<h4 id="kanban-heading-{row}-{state}" {oob}>{state} <small>({storypoints})</small></h4>"""
+
+
+class OobSwap(Component):
+    """<div hx-swap-oob="{swap}" data-rows="{rows}">{content}</div>"""
+
+
+class OobDelete(Component):
+    """<div id="{id}" hx-swap-oob="delete"></div>"""
+
+
 class TaskCard(Component):
     """
-    <article class="task-card" hx-drag='{{"task": "{id}"}}' draggable="{draggable}">
+    <article class="task-card" id="task-card-{id}" hx-drag='{{"task": "{id}"}}' draggable="{draggable}">
       {buttons}
       <a href="/tasks/{id}"><span class="id">{id}</span> <strong>{summary}</strong></a><br>
       <small>{details}</small>
@@ -137,6 +383,14 @@ class TaskCard(Component):
 
     @classmethod
     def from_row(cls, row, with_select_button=False, draggable=False):
+        return CachedCard(
+            row,
+            ("card", with_select_button, draggable),
+            lambda: cls._from_row(row, with_select_button, draggable),
+        )
+
+    @classmethod
+    def _from_row(cls, row, with_select_button, draggable):
         details = [
             User.from_task(row),
             Storypoints(row["storypoints_sum"] + row["storypoints"]),
@@ -160,30 +414,55 @@ class TaskCard(Component):
 
 class TaskRow(Component):
     """
-    <article class="task-card task-row">
+    <article class="task-card task-row" id="task-row-{id}">
+      <details {open} {lazy}>
+        <summary>{header}</summary>
+        <div class="swimlane">{items}</div>
+      </details>
+    </article>
+    """
+
+    @classmethod
+    def from_row(cls, row, items=None):
+        """
+        Without items, the swimlane is collapsed and only loaded when opened.
+        """
+        return cls(
+            id=row["id"],
+            header=CachedCard(row, "row", lambda: TaskRowHeader.from_row(row)),
+            items=items,
+            open="open" if items is not None else "",
+            lazy=SwimlaneLoader(id=row["id"]) if items is None else "",
+        )
+
+
+class SwimlaneLoader(Component):
+    """
+    hx-get="/tasks/{id}/swimlane" hx-trigger="toggle once" hx-target="find .swimlane"
+    """
+
+
+class TaskRowHeader(Component):
+    """
+    <span id="task-row-header-{id}" {oob}>
       <a href="/tasks/{id}"><span class="id">{id}</span> <strong>{summary}</strong></a>
       <small>{details}</small>
-      {items}
-    </article>
+    </span>
     """
 
     @classmethod
-    def from_row(cls, row, items):
+    def from_row(cls, row, oob=""):
         details = [
             User.from_task(row),
             Storypoints(row["storypoints_sum"] + row["storypoints"]),
         ]
         if row["n_subtasks"]:
             details.append(f"{row['n_subtasks']} subtasks")
+        if row["n_open_descendants"]:
+            details.append(f"{row['n_open_descendants']} open")
         if row["n_comments"]:
             details.append(f"{row['n_comments']} 💬")
-        data = {
-            "id": row["id"],
-            "summary": row["summary"],
-            "details": details,
-            "items": items,
-        }
-        return cls(**data)
+        return cls(id=row["id"], summary=row["summary"], details=details, oob=oob)
 
     sep = " · "
 
@@ -201,13 +480,15 @@ class TaskDetail(Component):
             <button hx-get="/tasks/new?parent_task_id={id}" hx-target="#popoverholder">New subtask</button>
             <button hx-get="/tasks/{id}/edit" hx-target="#popoverholder">Edit</button>
         </div>
-        <h3><span class="id">{id}</span> <strong>{title}</strong></h3>
+        {title}
     </header>
     {description}
     <footer>
     {subtasks}
+    <div id="comments">
     {comments}
-    <form hx-post="/tasks/{id}/comments">
+    </div>
+    <form hx-post="/tasks/{id}/comments" hx-on::after-request="this.reset()">
     <input
         placeholder="Add a new comment..."
         name="comment"
@@ -216,9 +497,19 @@ class TaskDetail(Component):
     </form>
     </footer>
     </article>
-    <div class="sidebar">
     {properties}
     </div>
+    """
+
+
+class TaskTitle(Component):
+    """<h3 id="task-title" {oob}><span class="id">{id}</span> <strong>{title}</strong></h3>"""
+
+
+class TaskProperties(Component):
+    """
+    <div class="sidebar" id="task-properties" {oob}>
+    {_0}
     </div>
     """
 
@@ -263,13 +554,25 @@ class LoggedOutPage(Component):
                 <li>zutun</li>
                 <li><a href="/">Board</a></li>
                 <li><a href="/backlog">Backlog</a></li>
+                <li><a href="/graveyard">Graveyard</a></li>
             </ul>
             <ul>
                 <li><button hx-get="/tasks/new" hx-target="#popoverholder">New task</button></li>
-                <li><input type="search"></li>
+                <li>
+                    <input
+                        type="search"
+                        name="q"
+                        placeholder="Search"
+                        autocomplete="off"
+                        hx-get="/search"
+                        hx-trigger="input changed delay:300ms, search"
+                        hx-target="#search-results"
+                    >
+                </li>
                 <!- LOGOUT -->
             </ul>
         </nav>
+        <div id="search-results"></div>
         <main>
             {body}
         </main>
@@ -413,8 +716,20 @@ class Storypoints(Component):
     default = {0: " – "}
 
 
+class Avatar(Component):
+    """<picture><source type="image/webp" srcset="{base}-{size}.webp, {base}-{size_2x}.webp 2x"><img class="avatar" src="{base}-{size}.jpg" srcset="{base}-{size_2x}.jpg 2x"></picture>"""
+
+    @classmethod
+    def from_url(cls, url, size=32):
+        """Pick the smallest renditions of the avatar at url that fit size."""
+        if not url:
+            return ""
+        base, _, _ = url.rpartition(".")
+        return cls(base=base, size=size, size_2x=min(2 * size, 128))
+
+
 class User(Component):
-    """<span class="user {user_set}"><img class="avatar" src="{avatar}">{name}</span>"""
+    """<span class="user {user_set}">{avatar}{name}</span>"""
 
     default = {"name": "<em>unassigned</em>", "avatar": "", "user_set": ""}
 
@@ -422,7 +737,7 @@ class User(Component):
     def from_task(cls, task):
         return cls(
             name=task["assignee_name"],
-            avatar=task["assignee_avatar"],
+            avatar=Avatar.from_url(task["assignee_avatar"]),
             user_set="user-set" if task["assignee_id"] else "",
         )
 
@@ -430,13 +745,13 @@ class User(Component):
     def from_comment(cls, comment):
         return cls(
             name=comment["commenter_name"] or "<em>anonymous</em>",
-            avatar=comment["commenter_avatar"],
+            avatar=Avatar.from_url(comment["commenter_avatar"]),
             user_set="user-set" if comment["commenter_id"] else "",
         )
 
 
 class Description(Component):
-    """<span class="description">{_0}</span>"""
+    """<span class="description" id="task-description" {oob}>{_0}</span>"""
 
     default = {0: "<em>(no description)</em>"}
 
@@ -471,7 +786,7 @@ class StateOption(Component):
 
 class Comment(Component):
     """
-    <div class="comment">
+    <div class="comment" id="comment-{id}">
     {commenter} wrote <em data-tooltip="{created_at}">{created_at_human}</em>:
     <span class="comment-text">{text}</comment>
     </div><hr>
@@ -484,8 +799,124 @@ class TaskLink(Component):
     """
 
 
+class SearchResults(Component):
+    """
+    <article class="search-results">
+    {hits}
+    {more}
+    </article>
+    """
+
+
+class SearchHit(Component):
+    """
+    <p>
+    <a href="/tasks/{task_id}"><span class="id">{task_id}</span> {summary}</a><br>
+    <small>{snippet}</small>
+    </p>
+    """
+
+
+class MoreSearchResults(Component):
+    """
+    <button class="outline" hx-get="/search?{query}" hx-target="this" hx-swap="outerHTML">
+        More results
+    </button>
+    """
+
+
+class NoSearchResults(Component):
+    """<p><em>Nothing found.</em></p>"""
+
+
 class LogoutBar(Component):
     """
-    <details class="dropdown"><summary><img class="avatar" src="{avatar}">{name}</summary>
+    <details class="dropdown"><summary>{avatar}{name}</summary>
     <ul><li><a href="/login">Logout</a></li></ul></details>
     """
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(name=user["name"], avatar=Avatar.from_url(user["avatar"], 64))
+
+
+class DebugFooter(Component):
+    """
+    <footer class="debug-timings">
+    <small>
+        {total} ms total, {db} ms in {n_queries} queries, {render} ms rendering
+    </small>
+    <table>
+    {statements}
+    </table>
+    </footer>
+    """
+
+    @classmethod
+    def from_timings(cls, timings):
+        return cls(
+            total=f"{timings.total * 1000:.1f}",
+            db=f"{timings.db * 1000:.1f}",
+            n_queries=len(timings.queries),
+            render=f"{timings.spans['render'] * 1000:.1f}",
+            statements=[
+                DebugStatement(
+                    count=count,
+                    duration=f"{duration * 1000:.1f}",
+                    sql=escape(sql),
+                )
+                for sql, (count, duration) in timings.by_statement()
+            ],
+        )
+
+
+class DebugStatement(Component):
+    """
+    <tr><td>{count}&times;</td><td>{duration}&nbsp;ms</td><td><code>{sql}</code></td></tr>
+    """
+
+
+class SlowQueries(Component):
+    """
+    <h2>Slow queries</h2>
+    <p>Statements that took at least {threshold} ms, grouped by shape.</p>
+    <article class="slow-queries">
+    <table>
+    <thead><tr><th>Count</th><th>p50</th><th>p95</th><th>Max</th><th>Statement</th></tr></thead>
+    <tbody>
+    {shapes}
+    </tbody>
+    </table>
+    </article>
+    """
+
+
+class SlowQueryShape(Component):
+    """
+    <tr>
+    <td>{count}</td><td>{p50}&nbsp;ms</td><td>{p95}&nbsp;ms</td><td>{max}&nbsp;ms</td>
+    <td>
+    <details>
+        <summary><code>{sql}</code></summary>
+        <small>Latest parameters: <code>{params}</code></small>
+        <pre>{plan}</pre>
+    </details>
+    </td>
+    </tr>
+    """
+
+    @classmethod
+    def from_shape(cls, sql, durations, latest):
+        return cls(
+            count=len(durations),
+            p50=f"{percentile(durations, 0.5) * 1000:.1f}",
+            p95=f"{percentile(durations, 0.95) * 1000:.1f}",
+            max=f"{durations[-1] * 1000:.1f}",
+            sql=escape(sql),
+            params=escape(repr(latest.params)),
+            plan=escape(latest.plan),
+        )
+
+
+class NoSlowQueries(Component):
+    """<tr><td colspan="5"><em>None yet.</em></td></tr>"""
@@ -0,0 +1,140 @@
+import os
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# HTML responses smaller than this are sent as-is; the headers would eat most
+# of the savings. Streamed responses are always compressed.
+MIN_SIZE = int(os.environ.get("ZUTUN_COMPRESSION_MIN_SIZE", 1024))
+# Per encoding, since their scales differ. The defaults favour speed, as
+# responses are compressed on every request.
+LEVELS = {
+    "br": int(os.environ.get("ZUTUN_BROTLI_LEVEL", 4)),
+    "zstd": int(os.environ.get("ZUTUN_ZSTD_LEVEL", 3)),
+    "gzip": int(os.environ.get("ZUTUN_GZIP_LEVEL", 6)),
+}
+# For what is compressed only once, like the static assets.
+MAX_LEVELS = {"br": 11, "zstd": 19, "gzip": 9}
+
+
+class GzipCompressor:
+    def __init__(self, level):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+class BrotliCompressor:
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data):
+        return self.compressor.process(data) + self.compressor.flush()
+
+    def finish(self):
+        return self.compressor.finish()
+
+
+class ZstdCompressor:
+    def __init__(self, level):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data) + self.compressor.flush(
+            zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        )
+
+    def finish(self):
+        return self.compressor.flush()
+
+
+# In order of preference, for when clients accept several equally.
+COMPRESSORS = {}
+if brotli:
+    COMPRESSORS["br"] = BrotliCompressor
+if zstandard:
+    COMPRESSORS["zstd"] = ZstdCompressor
+COMPRESSORS["gzip"] = GzipCompressor
+
+
+def accepted_encodings(header):
+    """Parse an Accept-Encoding header into a dict of encodings and q-values."""
+    accepted = {}
+    for part in header.split(","):
+        encoding, _, params = part.strip().partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if encoding:
+            accepted[encoding.lower()] = q
+    return accepted
+
+
+def negotiate(header, available):
+    """
+    Pick the best of the available encodings for an Accept-Encoding header.
+
+    Returns None if none of them is acceptable.
+    """
+    accepted = accepted_encodings(header or "")
+    best, best_q = None, 0.0
+    for encoding in available:
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compressor(encoding, level=None):
+    return COMPRESSORS[encoding](LEVELS[encoding] if level is None else level)
+
+
+def compress(data, encoding, level=None):
+    compressor_ = compressor(encoding, level)
+    return compressor_.compress(data) + compressor_.finish()
+
+
+class CompressedStream:
+    """
+    Stands in for the stream of a streamed response, compressing what is sent.
+
+    Every chunk is flushed through the compressor, so that what the handler
+    sends early still reaches the client early.
+    """
+
+    def __init__(self, stream, encoding):
+        self.stream = stream
+        self.compressor = compressor(encoding)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    @property
+    def send(self):
+        # The response checks this to find out whether the stream has ended.
+        if self.stream.send is None:
+            return None
+        return self._send
+
+    async def _send(self, data, end_stream):
+        data = self.compressor.compress(data) if data else b""
+        if end_stream:
+            data += self.compressor.finish()
+        await self.stream.send(data, end_stream=end_stream)
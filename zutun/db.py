@@ -1,11 +1,188 @@
 import os
 import sys
+import fcntl
+import base64
+import asyncio
+import hashlib
 import sqlite3
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 
-conn = sqlite3.connect(os.environ.get("ZUTUN_DB", "zutun.db"))
-conn.row_factory = sqlite3.Row
+from PIL import Image, UnidentifiedImageError
+
+from zutun.cache import caches
+from zutun.images import render_avatar
+from zutun.instrumentation import TimedConnection
+
+DB_PATH = os.environ.get("ZUTUN_DB", "zutun.db")
+N_READERS = 4
+BUSY_TIMEOUT = 5  # seconds
+
+
+def connect():
+    connection = sqlite3.connect(
+        DB_PATH,
+        timeout=BUSY_TIMEOUT,
+        check_same_thread=False,
+        factory=TimedConnection,
+    )
+    connection.row_factory = sqlite3.Row
+    # WAL (set once during migrations) makes NORMAL durable enough: a power
+    # loss can only lose the last commits, never corrupt the database.
+    connection.execute("PRAGMA synchronous = NORMAL")
+    connection.execute("PRAGMA cache_size = -16000")  # 16 MiB
+    connection.execute("PRAGMA mmap_size = 268435456")  # 256 MiB
+    return connection
+
+
+class Database:
+    """
+    Awaitable database access for the request handlers.
+
+    Queries run in a small pool of reader threads, each holding its own
+    connection, so concurrent requests overlap their I/O instead of stalling
+    the event loop. All writes go through one dedicated writer thread.
+    """
+
+    def __init__(self, n_readers=N_READERS):
+        self._local = threading.local()
+        self._readers = ThreadPoolExecutor(
+            n_readers, thread_name_prefix="zutun-db-read"
+        )
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="zutun-db-write")
+        # Only ever asked for its data_version, which changes with every
+        # commit, so that looking for other processes' writes never waits
+        # behind this one's.
+        self._probe = None
+        self._probe_lock = threading.Lock()
+        # The probe's data_version as of the last check or local write.
+        self._seen_data_version = None
+
+    def _connection(self):
+        try:
+            return self._local.connection
+        except AttributeError:
+            self._local.connection = connect()
+            return self._local.connection
+
+    async def _run(self, executor, fn):
+        # In the caller's context, so that queries count towards its request.
+        return await asyncio.get_running_loop().run_in_executor(
+            executor, contextvars.copy_context().run, fn
+        )
+
+    async def fetchone(self, sql, params=()):
+        return await self._run(
+            self._readers,
+            lambda: self._connection().execute(sql, params).fetchone(),
+        )
+
+    async def fetchall(self, sql, params=()):
+        return await self._run(
+            self._readers,
+            lambda: self._connection().execute(sql, params).fetchall(),
+        )
+
+    async def transaction(self, fn):
+        """Run fn(cursor) on the writer thread and commit afterwards."""
+
+        def run():
+            connection = self._connection()
+            # This commit changes the probe's data_version too, which is
+            # recorded as seen so the caches survive it. Only if nothing was
+            # unseen before, and no other process committed meanwhile: the
+            # writer's own data_version only changes with their commits.
+            foreign = _data_version(connection)
+            seen = self._probe_data_version() == self._seen_data_version
+            with connection:
+                cur = connection.cursor()
+                try:
+                    result = fn(cur)
+                finally:
+                    cur.close()
+            data_version = self._probe_data_version()
+            if seen and _data_version(connection) == foreign:
+                self._seen_data_version = data_version
+            return result
+
+        return await self._run(self._writer, run)
+
+    def _probe_data_version(self):
+        with self._probe_lock:
+            if self._probe is None:
+                self._probe = connect()
+            return _data_version(self._probe)
+
+    async def foreign_writes(self):
+        """Whether another process committed since the last check."""
+
+        def check():
+            data_version = self._probe_data_version()
+            seen, self._seen_data_version = self._seen_data_version, data_version
+            return seen is not None and data_version != seen
+
+        return await self._run(self._readers, check)
+
+    async def execute(self, sql, params=()):
+        return await self.transaction(
+            lambda cur: cur.execute(sql, params).lastrowid,
+        )
+
+
+def _data_version(connection):
+    # Bookkeeping, not one of the request's queries, so it isn't timed.
+    cur = connection.cursor(sqlite3.Cursor)
+    return cur.execute("PRAGMA data_version").fetchone()[0]
+
+
+async def forget_foreign_writes():
+    """
+    Drop all caches if another process wrote to the database since last time.
+
+    Writes in this process invalidate what they touch, but with several
+    workers, each one only learns about the others' writes this way.
+    """
+    if await db.foreign_writes():
+        for cache in caches:
+            cache.clear()
+
+
+def store_avatar(cur, data, mime_type="image/jpeg", renditions=None):
+    """
+    Store an avatar image by content hash and return its URL.
+
+    Smaller renditions (see zutun.images.render_avatar) are stored under the
+    same hash, and served as /avatars/<hash>-<size>.<ext>.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    cur.execute(
+        "INSERT OR IGNORE INTO avatars (hash, mime_type, data) VALUES (?, ?, ?)",
+        (digest, mime_type, data),
+    )
+    for (size, rendition_type), rendition in (renditions or {}).items():
+        cur.execute(
+            """
+            INSERT OR IGNORE INTO avatar_renditions (hash, size, mime_type, data)
+            VALUES (?, ?, ?, ?)
+            """,
+            (digest, size, rendition_type, rendition),
+        )
+    return f"/avatars/{digest}.{AVATAR_EXTENSIONS[mime_type]}"
+
+
+AVATAR_EXTENSIONS = {"image/jpeg": "jpg", "image/webp": "webp"}
+
+
+conn = connect()
+db = Database()
 orig_isolation_level, conn.isolation_level = conn.isolation_level, None
 
+# Every Sanic worker imports this module; only one of them may migrate at a
+# time, and the others must see the version it leaves behind.
+migration_lock = open(f"{DB_PATH}.lock", "w")
+fcntl.flock(migration_lock, fcntl.LOCK_EX)
+conn.execute("PRAGMA journal_mode = WAL")
 
 try:
     cur = conn.cursor()
@@ -131,4 +308,367 @@ def make_comments_nonanonymous(cur):
     """)
 
 
+@migration(7)
+def add_indexes(cur):
+    # Subtask lookups and rollups (n_subtasks, n_incomplete_subtasks,
+    # storypoints_sum) are answered from this index alone.
+    cur.execute("""
+        CREATE INDEX tasks_parent_task_id
+        ON tasks (parent_task_id, state, storypoints)
+    """)
+    # Board and backlog only ever list top-level tasks of one location.
+    cur.execute("""
+        CREATE INDEX tasks_toplevel_location
+        ON tasks (location) WHERE parent_task_id IS NULL
+    """)
+    cur.execute("""
+        CREATE INDEX tasks_assignee_id
+        ON tasks (assignee_id)
+    """)
+    cur.execute("""
+        CREATE INDEX comments_task_id
+        ON comments (task_id)
+    """)
+    cur.execute("ANALYZE")
+
+
+@migration(8)
+def move_avatars_out_of_users(cur):
+    cur.execute("""
+        CREATE TABLE avatars (
+            hash TEXT PRIMARY KEY,
+            mime_type TEXT NOT NULL,
+            data BLOB NOT NULL
+        )
+    """)
+    users = cur.execute("""
+        SELECT id, avatar FROM users WHERE avatar LIKE 'data:%'
+    """).fetchall()
+    for user in users:
+        _, _, encoded = user["avatar"].partition(",")
+        cur.execute(
+            "UPDATE users SET avatar = ? WHERE id = ?",
+            (store_avatar(cur, base64.b64decode(encoded)), user["id"]),
+        )
+
+
+@migration(9)
+def add_avatar_renditions(cur):
+    cur.execute("""
+        CREATE TABLE avatar_renditions (
+            hash TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            mime_type TEXT NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (hash, size, mime_type)
+        )
+    """)
+    for avatar in cur.execute("SELECT * FROM avatars").fetchall():
+        # Avatars uploaded before uploads were checked may not be renderable;
+        # those keep only their original.
+        try:
+            renditions = render_avatar(avatar["data"])
+        except (UnidentifiedImageError, Image.DecompressionBombError):
+            renditions = None
+        store_avatar(cur, avatar["data"], avatar["mime_type"], renditions=renditions)
+
+
+@migration(10)
+def add_rendered_html(cur):
+    # Filled in by zutun.references whenever descriptions or comments are
+    # written; NULL means "not rendered yet".
+    cur.execute("""
+        ALTER TABLE tasks
+        ADD COLUMN rendered_html TEXT
+    """)
+    cur.execute("""
+        ALTER TABLE comments
+        ADD COLUMN rendered_html TEXT
+    """)
+    cur.execute("""
+        CREATE TABLE reference_deps (
+            source_kind TEXT NOT NULL,
+            source_id INTEGER NOT NULL,
+            ref_kind TEXT NOT NULL,
+            ref_id INTEGER NOT NULL
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX reference_deps_source
+        ON reference_deps (source_kind, source_id)
+    """)
+    cur.execute("""
+        CREATE INDEX reference_deps_ref
+        ON reference_deps (ref_kind, ref_id)
+    """)
+
+
+@migration(11)
+def add_changes(cur):
+    # AUTOINCREMENT, so that sequence numbers are never reused once old
+    # changes are pruned.
+    cur.execute("""
+        CREATE TABLE changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            task_id INTEGER,
+            created_at TIMESTAMP DEFAULT (datetime('now'))
+        )
+    """)
+
+
+@migration(12)
+def add_versions(cur):
+    # Every row carries a version that triggers bump on each update, and
+    # state.data_version is bumped on every write to any of these tables.
+    cur.execute("""
+        ALTER TABLE state
+        ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0
+    """)
+    for table in ["tasks", "comments", "users"]:
+        cur.execute(f"""
+            ALTER TABLE {table}
+            ADD COLUMN version INTEGER NOT NULL DEFAULT 1
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER {table}_version AFTER UPDATE ON {table}
+            WHEN NEW.version = OLD.version
+            BEGIN
+                UPDATE {table} SET version = OLD.version + 1 WHERE id = NEW.id;
+            END
+        """)
+        for event in ["INSERT", "UPDATE", "DELETE"]:
+            cur.execute(f"""
+                CREATE TRIGGER {table}_{event.lower()}_data_version
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE state SET data_version = data_version + 1;
+                END
+            """)
+
+
+@migration(13)
+def add_task_closure(cur):
+    # Every (ancestor, descendant) pair of the task tree, including each task
+    # as its own ancestor at depth 0. Kept in sync by the triggers below.
+    cur.execute("""
+        CREATE TABLE task_closure (
+            ancestor_id INTEGER NOT NULL,
+            descendant_id INTEGER NOT NULL,
+            depth INTEGER NOT NULL,
+            PRIMARY KEY (ancestor_id, descendant_id)
+        ) WITHOUT ROWID
+    """)
+    cur.execute("""
+        CREATE INDEX task_closure_descendant
+        ON task_closure (descendant_id, depth)
+    """)
+    # Nothing prevented cycles before, so break any that exist.
+    parents = dict(cur.execute("SELECT id, parent_task_id FROM tasks").fetchall())
+    for task_id in parents:
+        seen = set()
+        while task_id is not None:
+            seen.add(task_id)
+            parent_task_id = parents.get(task_id)
+            if parent_task_id in seen:
+                cur.execute(
+                    "UPDATE tasks SET parent_task_id = NULL WHERE id = ?", (task_id,)
+                )
+                parents[task_id] = None
+                break
+            task_id = parent_task_id
+    cur.execute("""
+        INSERT INTO task_closure (ancestor_id, descendant_id, depth)
+        WITH RECURSIVE closure(ancestor_id, descendant_id, depth) AS (
+            SELECT id, id, 0 FROM tasks
+            UNION ALL
+            SELECT closure.ancestor_id, tasks.id, closure.depth + 1
+            FROM closure JOIN tasks ON tasks.parent_task_id = closure.descendant_id
+        )
+        SELECT * FROM closure
+    """)
+    cur.execute("""
+        CREATE TRIGGER task_closure_insert AFTER INSERT ON tasks
+        BEGIN
+            INSERT INTO task_closure (ancestor_id, descendant_id, depth)
+            SELECT NEW.id, NEW.id, 0
+            UNION ALL
+            SELECT ancestor_id, NEW.id, depth + 1 FROM task_closure
+            WHERE descendant_id = NEW.parent_task_id;
+        END
+    """)
+    # Detach the moved subtree from its old ancestors, then attach it to the
+    # new ones.
+    cur.execute("""
+        CREATE TRIGGER task_closure_move AFTER UPDATE OF parent_task_id ON tasks
+        WHEN OLD.parent_task_id IS NOT NEW.parent_task_id
+        BEGIN
+            DELETE FROM task_closure
+            WHERE descendant_id IN (
+                SELECT descendant_id FROM task_closure WHERE ancestor_id = NEW.id
+            )
+            AND ancestor_id IN (
+                SELECT ancestor_id FROM task_closure
+                WHERE descendant_id = NEW.id AND depth > 0
+            );
+            INSERT INTO task_closure (ancestor_id, descendant_id, depth)
+            SELECT above.ancestor_id, below.descendant_id, above.depth + below.depth + 1
+            FROM task_closure above, task_closure below
+            WHERE above.descendant_id = NEW.parent_task_id
+            AND below.ancestor_id = NEW.id;
+        END
+    """)
+    cur.execute("""
+        CREATE TRIGGER task_closure_delete AFTER DELETE ON tasks
+        BEGIN
+            DELETE FROM task_closure
+            WHERE ancestor_id = OLD.id OR descendant_id = OLD.id;
+        END
+    """)
+
+
+@migration(14)
+def add_search(cur):
+    # One row per task (summary and description) and per comment (text
+    # only). Rowids are 2 * id for tasks and 2 * id + 1 for comments, so that
+    # the triggers can find a row without a scan.
+    cur.execute("""
+        CREATE VIRTUAL TABLE search USING fts5(
+            task_id UNINDEXED,
+            summary,
+            body,
+            prefix = '2 3',
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    """)
+    # Rank matches in the summary far above ones in the body.
+    cur.execute("""
+        INSERT INTO search (search, rank) VALUES ('rank', 'bm25(0.0, 10.0, 1.0)')
+    """)
+    cur.execute("""
+        INSERT INTO search (rowid, task_id, summary, body)
+        SELECT 2 * id, id, summary, description FROM tasks
+        UNION ALL
+        SELECT 2 * id + 1, task_id, NULL, text FROM comments
+    """)
+    for table, rowid, task_id, summary, body in [
+        ("tasks", "2 * {}.id", "{}.id", "{}.summary", "{}.description"),
+        ("comments", "2 * {}.id + 1", "{}.task_id", "NULL", "{}.text"),
+    ]:
+        insert = f"""
+            INSERT INTO search (rowid, task_id, summary, body) VALUES (
+                {rowid.format("NEW")},
+                {task_id.format("NEW")},
+                {summary.format("NEW")},
+                {body.format("NEW")}
+            );
+        """
+        delete = f"""
+            DELETE FROM search WHERE rowid = {rowid.format("OLD")};
+        """
+        cur.execute(f"""
+            CREATE TRIGGER {table}_search_insert AFTER INSERT ON {table}
+            BEGIN {insert} END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER {table}_search_update AFTER UPDATE ON {table}
+            WHEN {summary.format("OLD")} IS NOT {summary.format("NEW")}
+            OR {body.format("OLD")} IS NOT {body.format("NEW")}
+            OR {task_id.format("OLD")} IS NOT {task_id.format("NEW")}
+            BEGIN {delete} {insert} END
+        """)
+        cur.execute(f"""
+            CREATE TRIGGER {table}_search_delete AFTER DELETE ON {table}
+            BEGIN {delete} END
+        """)
+
+
+@migration(15)
+def add_counters(cur):
+    cur.execute("""
+        CREATE TABLE counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    """)
+    # Top-level tasks in the backlog.
+    in_backlog = "{0}.location = 'backlog' AND {0}.parent_task_id IS NULL"
+    cur.execute(f"""
+        INSERT INTO counters (name, value)
+        SELECT 'backlog', COUNT(*) FROM tasks WHERE {in_backlog.format("tasks")}
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER counters_backlog_insert AFTER INSERT ON tasks
+        WHEN {in_backlog.format("NEW")}
+        BEGIN
+            UPDATE counters SET value = value + 1 WHERE name = 'backlog';
+        END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER counters_backlog_update
+        AFTER UPDATE OF location, parent_task_id ON tasks
+        BEGIN
+            UPDATE counters
+            SET value = value
+                + ({in_backlog.format("NEW")})
+                - ({in_backlog.format("OLD")})
+            WHERE name = 'backlog';
+        END
+    """)
+    cur.execute(f"""
+        CREATE TRIGGER counters_backlog_delete AFTER DELETE ON tasks
+        WHEN {in_backlog.format("OLD")}
+        BEGIN
+            UPDATE counters SET value = value - 1 WHERE name = 'backlog';
+        END
+    """)
+
+
+@migration(16)
+def add_archive(cur):
+    # Graveyard tasks and their comments are moved here by zutun.archive, so
+    # that the tables the board and backlog read stay small.
+    cur.execute("""
+        CREATE TABLE archived_tasks (
+            id INTEGER PRIMARY KEY,
+            summary TEXT NOT NULL,
+            description TEXT,
+            state TEXT,
+            storypoints INTEGER,
+            parent_task_id INTEGER,
+            assignee_id INTEGER,
+            rendered_html TEXT,
+            archived_at TIMESTAMP DEFAULT (datetime('now'))
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX archived_tasks_parent_task_id
+        ON archived_tasks (parent_task_id)
+    """)
+    cur.execute("""
+        CREATE TABLE archived_comments (
+            id INTEGER PRIMARY KEY,
+            task_id INTEGER NOT NULL,
+            text TEXT,
+            created_at TIMESTAMP,
+            commenter_id INTEGER,
+            rendered_html TEXT
+        )
+    """)
+    cur.execute("""
+        CREATE INDEX archived_comments_task_id
+        ON archived_comments (task_id)
+    """)
+
+
+@migration(17)
+def add_archived_comments_original_id(cur):
+    # Comment ids are reused once the highest one is archived, so archived
+    # comments get ids of their own; the one they had is kept for reference.
+    cur.execute("ALTER TABLE archived_comments ADD COLUMN original_id INTEGER")
+    cur.execute("UPDATE archived_comments SET original_id = id")
+
+
+conn.execute("PRAGMA optimize")
 conn.isolation_level = orig_isolation_level
+fcntl.flock(migration_lock, fcntl.LOCK_UN)
+migration_lock.close()
@@ -0,0 +1,88 @@
+import asyncio
+import resource
+import warnings
+import multiprocessing
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+
+AVATAR_SIZES = [32, 64, 128]
+AVATAR_FORMATS = {"image/webp": "WEBP", "image/jpeg": "JPEG"}
+MAX_UPLOAD_BYTES = 16 * 1024 * 1024
+MAX_WORKER_MEMORY = 1024 * 1024 * 1024
+# Pillow warns above this many pixels and refuses at twice as many; we
+# refuse as soon as it warns, with the same DecompressionBombError. Well above
+# the 48 and 50 megapixels of current phone cameras.
+Image.MAX_IMAGE_PIXELS = 100_000_000
+
+
+def scale_image(img, target_size):
+    """
+    Scale image to a fixed, square size.
+
+    When the original image isn't a square, take only the central, square
+    portion.
+    """
+    max_size = max(img.size)
+    min_size = min(img.size)
+    x, y = img.size
+    x_diff, y_diff = (max_size - x) // 2, (max_size - y) // 2
+    return img.resize(
+        (
+            target_size,
+            target_size,
+        ),
+        box=(
+            0 + y_diff,
+            0 + x_diff,
+            min_size + y_diff,
+            min_size + x_diff,
+        ),
+        reducing_gap=2.0,
+    )
+
+
+def render_avatar(data):
+    """
+    Render an uploaded image in every avatar size and format.
+
+    Returns a dict mapping (size, mime_type) to the encoded image.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("error", Image.DecompressionBombWarning)
+        try:
+            img = Image.open(BytesIO(data))
+            # Lets the JPEG decoder scale down by up to 8x while decoding,
+            # which is far cheaper than decoding a full phone photo and
+            # resizing it.
+            img.draft("RGB", (max(AVATAR_SIZES), max(AVATAR_SIZES)))
+            img = img.convert("RGB")
+        except Image.DecompressionBombWarning as e:
+            raise Image.DecompressionBombError(str(e)) from None
+    renditions = {}
+    for size in sorted(AVATAR_SIZES, reverse=True):
+        img = scale_image(img, size)
+        for mime_type, format in AVATAR_FORMATS.items():
+            io = BytesIO()
+            img.save(io, format=format, quality=85)
+            renditions[size, mime_type] = io.getvalue()
+    return renditions
+
+
+def _limit_memory():
+    resource.setrlimit(resource.RLIMIT_AS, (MAX_WORKER_MEMORY, MAX_WORKER_MEMORY))
+
+
+pool = ProcessPoolExecutor(
+    max_workers=2,
+    mp_context=multiprocessing.get_context("spawn"),
+    initializer=_limit_memory,
+)
+
+
+async def process_avatar(data):
+    return await asyncio.get_running_loop().run_in_executor(
+        pool, render_avatar, data
+    )
@@ -0,0 +1,265 @@
+import os
+import re
+import math
+import time
+import sqlite3
+from time import perf_counter
+from functools import lru_cache
+from contextvars import ContextVar
+from contextlib import contextmanager
+from collections import defaultdict, deque
+
+
+# "1" times every request; "debug" also appends the timings to HTML pages.
+INSTRUMENT = os.environ.get("ZUTUN_INSTRUMENT", "")
+# Statements that take at least this long are logged, with their query plan.
+SLOW_QUERY_THRESHOLD = float(os.environ.get("ZUTUN_SLOW_QUERY_MS", 100)) / 1000
+SLOW_QUERY_LOG_SIZE = 1000
+MAX_PARAM_LENGTH = 100
+
+# The Timings of the request being handled, if instrumentation is on. Database
+# threads see it too, as queries are run in a copy of the caller's context.
+current = ContextVar("timings", default=None)
+
+
+@lru_cache(maxsize=1024)
+def normalize(sql):
+    """Reduce a statement to its shape, for grouping."""
+    sql = " ".join(sql.split())
+    return re.sub(r"\(\?(?:, ?\?)+\)", "(?, ...)", sql)
+
+
+class Timings:
+    """What one request spent its time on, in seconds."""
+
+    def __init__(self):
+        self.start = perf_counter()
+        # Lists of [normalized SQL, duration], so that fetches can add to them.
+        self.queries = []
+        self.spans = defaultdict(float)
+        self.open_spans = set()
+
+    def query(self, sql, duration):
+        query = [normalize(sql), duration]
+        self.queries.append(query)
+        return query
+
+    @property
+    def db(self):
+        return sum(duration for _, duration in self.queries)
+
+    @property
+    def total(self):
+        return perf_counter() - self.start
+
+    def by_statement(self):
+        """Count and total duration per statement, slowest first."""
+        statements = defaultdict(lambda: [0, 0.0])
+        for sql, duration in self.queries:
+            statements[sql][0] += 1
+            statements[sql][1] += duration
+        return sorted(statements.items(), key=lambda item: -item[1][1])
+
+    def server_timing(self):
+        metrics = [f'db;dur={self.db * 1000:.1f};desc="{len(self.queries)} queries"']
+        for name, duration in self.spans.items():
+            metrics.append(f"{name};dur={duration * 1000:.1f}")
+        metrics.append(f"total;dur={self.total * 1000:.1f}")
+        return ", ".join(metrics)
+
+    def as_dict(self):
+        return {
+            "total_ms": round(self.total * 1000, 1),
+            "db_ms": round(self.db * 1000, 1),
+            "queries": len(self.queries),
+            **{f"{name}_ms": round(d * 1000, 1) for name, d in self.spans.items()},
+        }
+
+
+@contextmanager
+def span(name):
+    """
+    Add the time spent in the block to the named span of the current request.
+
+    Nested blocks of the same name are only counted once.
+    """
+    timings = current.get()
+    if timings is None or name in timings.open_spans:
+        yield
+        return
+    timings.open_spans.add(name)
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        timings.spans[name] += perf_counter() - start
+        timings.open_spans.discard(name)
+
+
+def timed_iter(name, iterable):
+    """Like span(), but for the time spent producing each item of iterable."""
+    if current.get() is None:
+        return iterable
+    return _timed_iter(name, iter(iterable))
+
+
+def _timed_iter(name, iterator):
+    while True:
+        with span(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+class SlowQuery:
+    def __init__(self, sql, params, duration, plan):
+        self.sql = sql
+        self.params = params
+        self.duration = duration
+        self.plan = plan
+        self.at = time.time()
+
+
+def _describe_params(params):
+    """Keep logged parameters short; avatars are stored as blobs."""
+    if isinstance(params, dict):
+        return {key: _describe_param(value) for key, value in params.items()}
+    return [_describe_param(value) for value in params]
+
+
+def _describe_param(value):
+    if isinstance(value, bytes):
+        return f"<{len(value)} bytes>"
+    if isinstance(value, str) and len(value) > MAX_PARAM_LENGTH:
+        return value[:MAX_PARAM_LENGTH] + "..."
+    return value
+
+
+def explain(connection, sql, params):
+    """EXPLAIN QUERY PLAN output of a statement, as an indented tree."""
+    try:
+        rows = connection.cursor(sqlite3.Cursor).execute(
+            f"EXPLAIN QUERY PLAN {sql}", params
+        )
+        depths, lines = {0: -1}, []
+        for id, parent, _, detail in rows:
+            depths[id] = depths.get(parent, -1) + 1
+            lines.append("  " * depths[id] + detail)
+        return "\n".join(lines)
+    except (sqlite3.Error, ValueError) as e:
+        return f"(no plan: {e})"
+
+
+class SlowQueryLog:
+    """The last SLOW_QUERY_LOG_SIZE statements that took at least the threshold."""
+
+    def __init__(self, threshold=SLOW_QUERY_THRESHOLD, size=SLOW_QUERY_LOG_SIZE):
+        self.threshold = threshold
+        self.entries = deque(maxlen=size)
+
+    def record(self, connection, sql, params, duration):
+        entry = SlowQuery(
+            normalize(sql),
+            _describe_params(params),
+            duration,
+            explain(connection, sql, params),
+        )
+        self.entries.append(entry)
+        return entry
+
+    def by_shape(self):
+        """
+        Group the entries by normalized statement, slowest (by p95) first.
+
+        Returns (sql, durations, latest entry) tuples, with sorted durations.
+        """
+        shapes = {}
+        for entry in list(self.entries):
+            durations, _ = shapes.get(entry.sql, ([], None))
+            durations.append(entry.duration)
+            shapes[entry.sql] = durations, entry
+        return sorted(
+            (
+                (sql, sorted(durations), latest)
+                for sql, (durations, latest) in shapes.items()
+            ),
+            key=lambda shape: -percentile(shape[1], 0.95),
+        )
+
+
+def percentile(sorted_values, q):
+    """The nearest-rank percentile of a non-empty sorted list."""
+    return sorted_values[max(math.ceil(q * len(sorted_values)) - 1, 0)]
+
+
+slow_queries = SlowQueryLog()
+
+
+class TimedCursor(sqlite3.Cursor):
+    sql = None
+    # The statement's [sql, duration] in the request's Timings, and its entry
+    # in the slow query log.
+    query = None
+    slow = None
+
+    def _timed(self, method, sql, params, logged_params):
+        start = perf_counter()
+        try:
+            return method(sql, params)
+        finally:
+            duration = perf_counter() - start
+            self.sql, self.params, self.duration = sql, logged_params, duration
+            self.slow = None
+            timings = current.get()
+            self.query = None if timings is None else timings.query(sql, duration)
+            self._check_slow()
+
+    def execute(self, sql, params=()):
+        return self._timed(super().execute, sql, params, params)
+
+    def executemany(self, sql, params):
+        # Only the statement is logged; its parameters may be an iterator.
+        return self._timed(super().executemany, sql, params, ())
+
+    def _check_slow(self):
+        if self.duration < slow_queries.threshold:
+            return
+        if self.slow is None:
+            self.slow = slow_queries.record(
+                self.connection, self.sql, self.params, self.duration
+            )
+        else:
+            self.slow.duration = self.duration
+
+    def _fetch(self, method):
+        # SQLite does most of the work of a query while its rows are fetched.
+        if self.sql is None:
+            return method()
+        start = perf_counter()
+        try:
+            return method()
+        finally:
+            duration = perf_counter() - start
+            self.duration += duration
+            if self.query is not None:
+                self.query[1] += duration
+            self._check_slow()
+
+    def fetchone(self):
+        return self._fetch(super().fetchone)
+
+    def fetchall(self):
+        return self._fetch(super().fetchall)
+
+
+class TimedConnection(sqlite3.Connection):
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, params):
+        return self.cursor().executemany(sql, params)
@@ -0,0 +1,141 @@
+import io
+import os
+import re
+import time
+import pstats
+import marshal
+import cProfile
+import tempfile
+import itertools
+from glob import glob
+
+
+# Every this many requests are profiled into the sampled aggregate; 0 turns
+# sampling off. Requests can always ask to be profiled (see app.start_profile).
+PROFILE_EVERY = int(os.environ.get("ZUTUN_PROFILE_EVERY", 0))
+# Profiles are kept as .prof files here, so that every worker can show the
+# ones the others took. Delete it to start the sampled aggregate over.
+PROFILE_DIR = os.environ.get(
+    "ZUTUN_PROFILE_DIR", os.path.join(tempfile.gettempdir(), "zutun-profiles")
+)
+PROFILE_ID = re.compile(r"\d+-\d+")
+MAX_PROFILES = 20
+# Requests whose connection is dropped mid-stream never report back; their
+# profile is stopped when the next one starts after this long.
+ABANDONED_AFTER = 60  # seconds
+# What the sampled aggregate shows, as a pstats restriction.
+HOT_MODULES = r"zutun/(app|components)\.py"
+SORT_KEYS = {"cumulative", "tottime", "ncalls"}
+
+
+class RequestProfile:
+    def __init__(self, id):
+        # None for sampled requests, which only count towards the aggregate.
+        self.id = id
+        self.started = time.monotonic()
+        self.profile = cProfile.Profile()
+
+
+class Profiler:
+    """
+    Profiles requests that ask for it, and every PROFILE_EVERY-th request.
+
+    cProfile only sees the event loop's thread, so queries show up as time
+    spent awaiting them, and other requests handled meanwhile are profiled
+    too. Only one request is profiled at a time.
+    """
+
+    def __init__(self, every=PROFILE_EVERY):
+        self.every = every
+        self.n_requests = 0
+        self.active = None
+        self.ids = itertools.count(1)
+        self.sampled = None
+
+    def start(self, requested):
+        sampled = False
+        if self.every:
+            self.n_requests += 1
+            sampled = self.n_requests % self.every == 0
+        if not (requested or sampled):
+            return None
+        if self.active:
+            if time.monotonic() - self.active.started < ABANDONED_AFTER:
+                return None
+            self.stop(self.active)
+        # Unique across workers, as the profile may be asked for from another.
+        id = f"{os.getpid()}-{next(self.ids)}" if requested else None
+        self.active = RequestProfile(id)
+        self.active.profile.enable()
+        return self.active
+
+    def stop(self, request_profile):
+        if self.active is not request_profile:
+            return  # abandoned, and already stopped
+        request_profile.profile.disable()
+        self.active = None
+        stats = pstats.Stats(request_profile.profile)
+        if request_profile.id is not None:
+            _write(f"{request_profile.id}.prof", stats)
+            _prune()
+            return
+        if self.sampled is None:
+            self.sampled = stats
+        else:
+            self.sampled.add(stats)
+        _write(f"sampled-{os.getpid()}.prof", self.sampled)
+
+
+def _write(name, stats):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, name)
+    # Replaced in one go, as other workers may be reading it.
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(dump_stats(stats))
+    os.replace(f"{path}.tmp", path)
+
+
+def _prune():
+    """Remove all but the newest MAX_PROFILES profiles of single requests."""
+    paths = sorted(
+        glob(os.path.join(PROFILE_DIR, "[0-9]*-[0-9]*.prof")), key=os.path.getmtime
+    )
+    for path in paths[:-MAX_PROFILES]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass  # another worker was quicker
+
+
+def load_profile(id):
+    """The stats of a single request's profile, or None if it is gone."""
+    if not PROFILE_ID.fullmatch(id):
+        return None
+    try:
+        return pstats.Stats(os.path.join(PROFILE_DIR, f"{id}.prof"))
+    except FileNotFoundError:
+        return None
+
+
+def load_sampled():
+    """The sampled aggregates of all workers combined, and how many there are."""
+    paths = glob(os.path.join(PROFILE_DIR, "sampled-*.prof"))
+    if not paths:
+        return None, 0
+    return pstats.Stats(*paths), len(paths)
+
+
+def format_stats(stats, sort="cumulative", *restrictions):
+    """The pstats report of stats, as text."""
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.sort_stats(sort).print_stats(*restrictions)
+    return stream.getvalue()
+
+
+def dump_stats(stats):
+    """What pstats.Stats.dump_stats would write, for snakeviz and friends."""
+    return marshal.dumps(stats.stats)
+
+
+profiler = Profiler()
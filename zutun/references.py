@@ -0,0 +1,182 @@
+import re
+
+from zutun.cache import LRUCache
+from zutun.components import Avatar, TaskLink, User
+from zutun.db import db, forget_foreign_writes
+from zutun.instrumentation import span
+
+
+TASK_PATTERN = re.compile(r"#(\d+)\b")
+USER_PATTERN = re.compile(r"@(\d+)\b")
+
+
+# Rendered reference HTML, keyed by ("task", id) or ("user", id).
+links = LRUCache(maxsize=1024)
+
+
+def invalidate_task(task_id):
+    links.invalidate(("task", int(task_id)))
+
+
+def _render_task(task):
+    return str(TaskLink(id=task["id"], summary=task["summary"]))
+
+
+def _render_user(user):
+    return str(
+        User(
+            user_set="user-set",
+            name=user["name"],
+            avatar=Avatar.from_url(user["avatar"]),
+        )
+    )
+
+
+REFERENCE_KINDS = [
+    (
+        "task",
+        TASK_PATTERN,
+        "SELECT id, summary FROM tasks WHERE id IN ({})",
+        _render_task,
+    ),
+    (
+        "user",
+        USER_PATTERN,
+        "SELECT id, name, avatar FROM users WHERE id IN ({})",
+        _render_user,
+    ),
+]
+
+
+async def _resolve(kind, ids, query, render):
+    resolved = {}
+    missing = []
+    for id in ids:
+        html = links.get((kind, id))
+        if html is None:
+            missing.append(id)
+        else:
+            resolved[id] = html
+    if missing:
+        rows = await db.fetchall(query.format(",".join("?" * len(missing))), missing)
+        for row in rows:
+            resolved[row["id"]] = links[kind, row["id"]] = render(row)
+    return resolved
+
+
+async def replace_references(texts):
+    """
+    Expand #task and @user references in all of texts.
+
+    References are collected across all texts first, so each kind costs at
+    most one query. References to missing tasks or users are left as-is.
+    """
+    with span("references"):
+        await forget_foreign_writes()
+        for kind, pattern, query, render in REFERENCE_KINDS:
+            ids = {int(id) for text in texts if text for id in pattern.findall(text)}
+            if not ids:
+                continue
+            resolved = await _resolve(kind, ids, query, render)
+
+            def replace(match):
+                return resolved.get(int(match.group(1)), match.group(0))
+
+            texts = [pattern.sub(replace, text) if text else text for text in texts]
+        return texts
+
+
+# Where the source text of each kind of pre-rendered row lives.
+SOURCES = {"task": ("tasks", "description"), "comment": ("comments", "text")}
+
+
+def _references(text):
+    return {
+        (kind, int(id))
+        for kind, pattern, _, _ in REFERENCE_KINDS
+        for id in pattern.findall(text or "")
+    }
+
+
+def store_rendered(cur, source_kind, source_id, text, rendered_html):
+    """
+    Save the pre-rendered HTML of a task description or comment.
+
+    Also records which tasks and users it references, so that it can be
+    re-rendered when they change. Nothing is saved if the source text has been
+    edited since it was rendered.
+    """
+    table, column = SOURCES[source_kind]
+    cur.execute(
+        f"UPDATE {table} SET rendered_html = ? WHERE id = ? AND {column} IS ?",
+        (rendered_html, source_id, text),
+    )
+    if not cur.rowcount:
+        return
+    cur.execute(
+        "DELETE FROM reference_deps WHERE source_kind = ? AND source_id = ?",
+        (source_kind, source_id),
+    )
+    cur.executemany(
+        """
+        INSERT INTO reference_deps (source_kind, source_id, ref_kind, ref_id)
+        VALUES (?, ?, ?, ?)
+        """,
+        [
+            (source_kind, source_id, ref_kind, ref_id)
+            for ref_kind, ref_id in _references(text)
+        ],
+    )
+
+
+async def rerender(sources):
+    """Re-render the given (source_kind, source_id) rows."""
+    rows = []
+    for source_kind, (table, column) in SOURCES.items():
+        ids = [id for kind, id in sources if kind == source_kind]
+        if ids:
+            rows.extend(
+                await db.fetchall(
+                    f"""
+                    SELECT '{source_kind}' AS kind, id, {column} AS text
+                    FROM {table} WHERE id IN ({",".join("?" * len(ids))})
+                    """,
+                    ids,
+                )
+            )
+    if not rows:
+        return
+    rendered = await replace_references([row["text"] for row in rows])
+
+    def store(cur):
+        for row, rendered_html in zip(rows, rendered):
+            store_rendered(cur, row["kind"], row["id"], row["text"], rendered_html)
+
+    await db.transaction(store)
+
+
+async def rerender_dependents(ref_kind, ref_id):
+    """Re-render everything that references the given task or user."""
+    links.invalidate((ref_kind, int(ref_id)))
+    rows = await db.fetchall(
+        """
+        SELECT source_kind, source_id FROM reference_deps
+        WHERE ref_kind = ? AND ref_id = ?
+        """,
+        (ref_kind, ref_id),
+    )
+    await rerender([(row["source_kind"], row["source_id"]) for row in rows])
+
+
+async def rerender_missing():
+    """Render rows written before pre-rendering existed."""
+    rows = await db.fetchall(
+        """
+        SELECT 'task' AS kind, id FROM tasks
+        WHERE rendered_html IS NULL AND description <> ''
+        UNION ALL
+        SELECT 'comment' AS kind, id FROM comments
+        WHERE rendered_html IS NULL AND text <> ''
+        """
+    )
+    await rerender([(row["kind"], row["id"]) for row in rows])
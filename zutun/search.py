@@ -0,0 +1,53 @@
+from zutun.db import db
+
+
+SEARCH_PAGE_SIZE = 20
+# Shorter last words only match whole words; as prefixes, they'd match so
+# many different words that ranking gets slow.
+MIN_PREFIX_LENGTH = 3
+SEARCH_QUERY = """
+    SELECT
+        search.task_id AS task_id,
+        COALESCE(
+            highlight(search, 1, '<mark>', '</mark>'),
+            tasks.summary
+        ) AS summary,
+        snippet(search, 2, '<mark>', '</mark>', '…', 16) AS snippet
+    FROM search
+    JOIN tasks ON tasks.id = search.task_id
+    WHERE search MATCH ?
+    ORDER BY rank
+    LIMIT ? OFFSET ?
+"""
+
+
+def fts_query(text):
+    """
+    Turn what was typed into an FTS5 query.
+
+    Every word has to match, the last one as a prefix, since it is probably
+    still being typed. Words are quoted, so FTS5 syntax can't get in the way.
+    """
+    words = text.split()
+    if not words:
+        return None
+    query = " ".join('"{}"'.format(word.replace('"', '""')) for word in words)
+    if len(words[-1]) >= MIN_PREFIX_LENGTH:
+        query += "*"
+    return query
+
+
+async def search(text, page=0):
+    """
+    Return one page of tasks and comments matching text, best matches first.
+
+    Also returns whether there are more pages.
+    """
+    query = fts_query(text)
+    if query is None:
+        return [], False
+    hits = await db.fetchall(
+        SEARCH_QUERY,
+        (query, SEARCH_PAGE_SIZE + 1, page * SEARCH_PAGE_SIZE),
+    )
+    return hits[:SEARCH_PAGE_SIZE], len(hits) > SEARCH_PAGE_SIZE